@@ -0,0 +1,107 @@
+import argparse, json, marshal, os, resource, tempfile, time
+from lisp import read
+import corpus
+
+# Every measurement runs in a forked child, so that ru_maxrss reflects
+# that run alone and no memory is left over from the previous one.
+def measure(function, source, path, engine, repeat):
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        try:
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            best = None
+            for _ in range(repeat):
+                start = time.time()
+                if function == 'string':
+                    tree = read.string(source, path, engine)
+                else:
+                    tree = read.file(path, engine)
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+                peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                nodes = count(tree)
+                del tree
+            result = {'seconds': best, 'nodes': nodes, 'peak': peak - before}
+        except Exception, e:
+            result = {'error': '%s: %s' % (e.__class__.__name__, e)}
+        finally:
+            os.write(wfd, marshal.dumps(result))
+            os._exit(0)
+    os.close(wfd)
+    data = []
+    while True:
+        chunk = os.read(rfd, 4096)
+        if not chunk:
+            break
+        data.append(chunk)
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    return marshal.loads(''.join(data))
+
+def count(tree):
+    total = 0
+    nodes = [tree]
+    while len(nodes) > 0:
+        node = nodes.pop()
+        total += 1
+        if node.name == 'list':
+            nodes.extend(node.value)
+        elif node.name == 'attribute' and node.value[1] is not None:
+            nodes.append(node.value[1])
+    return total
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m bench',
+        description='Measure lisp.read throughput on synthetic corpora.')
+    parser.add_argument('--corpus', default=','.join(sorted(corpus.corpora)))
+    parser.add_argument('--sizes', default='65536,262144,1048576')
+    parser.add_argument('--engines', default=','.join(sorted(read.engines)))
+    parser.add_argument('--functions', default='string,file')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', help='store the results as a baseline')
+    parser.add_argument('--baseline', help='compare against a stored baseline')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as fd:
+            baseline = json.load(fd)
+
+    results = {}
+    print '%-10s %8s %-6s %-6s %9s %11s %9s' % (
+        'corpus', 'size', 'read', 'engine', 'MB/s', 'nodes/s', 'peak KB'),
+    print ' baseline' if baseline else ''
+    for name in args.corpus.split(','):
+        for size in [int(size) for size in args.sizes.split(',')]:
+            source = corpus.generate(name, size)
+            fd, path = tempfile.mkstemp(suffix='.lisp')
+            os.write(fd, source)
+            os.close(fd)
+            try:
+                for function in args.functions.split(','):
+                    for engine in args.engines.split(','):
+                        key = '%s/%d/%s/%s' % (name, size, function, engine)
+                        result = measure(function, source, path, engine, args.repeat)
+                        if 'error' in result:
+                            print '%-10s %8d %-6s %-6s %s' % (
+                                name, size, function, engine, result['error'])
+                            continue
+                        results[key] = result
+                        seconds = max(result['seconds'], 1e-9)
+                        mbs = len(source) / seconds / (1 << 20)
+                        line = '%-10s %8d %-6s %-6s %9.2f %11.0f %9d' % (
+                            name, size, function, engine, mbs,
+                            result['nodes'] / seconds, result['peak'])
+                        if key in baseline:
+                            line += ' %8.2fx' % (baseline[key]['seconds'] / seconds)
+                        print line
+            finally:
+                os.remove(path)
+    if args.save:
+        with open(args.save, 'w') as fd:
+            json.dump(results, fd, indent=1, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import random
+
+# Synthetic reader inputs. Each generator writes top-level forms until
+# the text reaches the requested size, using a fixed seed so that runs
+# can be compared with each other.
+
+def words(rng, count, length=8):
+    alphabet = 'abcdefghijklmnopqrstuvwxyz_-'
+    return [''.join(rng.choice(alphabet) for _ in range(rng.randint(1, length)))
+            for _ in range(count)]
+
+def nested(rng, size):
+    out = []
+    total = 0
+    while total < size:
+        depth = rng.randint(50, 200)
+        form = '(a ' * depth + 'x' + ')' * depth + '\n'
+        out.append(form)
+        total += len(form)
+    return ''.join(out)
+
+def strings(rng, size):
+    out = []
+    total = 0
+    while total < size:
+        text = 'x' * rng.randint(100, 4000)
+        form = '(debug "%s")\n' % text
+        out.append(form)
+        total += len(form)
+    return ''.join(out)
+
+def symbols(rng, size):
+    names = words(rng, 500, 4)
+    out = []
+    total = 0
+    while total < size:
+        form = '(%s)\n' % ' '.join(rng.choice(names) for _ in range(20))
+        out.append(form)
+        total += len(form)
+    return ''.join(out)
+
+def comments(rng, size):
+    names = words(rng, 100)
+    out = []
+    total = 0
+    while total < size:
+        form = '# %s\n# %s\n(%s 1) # %s\n' % (
+            ' '.join(names[:rng.randint(5, 20)]),
+            ' '.join(names[:rng.randint(5, 20)]),
+            rng.choice(names),
+            ' '.join(names[:rng.randint(1, 5)]))
+        out.append(form)
+        total += len(form)
+    return ''.join(out)
+
+def attributes(rng, size):
+    names = ['lib', 'stdlib', 'event', 'SDL_Event', 'SDL_QUIT', 'type', 'STDOUT_FILENO']
+    out = []
+    total = 0
+    while total < size:
+        chains = ['.'.join(rng.choice(names) for _ in range(rng.randint(2, 5)))
+                  for _ in range(rng.randint(1, 6))]
+        form = '(%s)\n' % ' '.join(chains)
+        out.append(form)
+        total += len(form)
+    return ''.join(out)
+
+def program(rng, size):
+    names = words(rng, 200)
+    out = []
+    total = 0
+    while total < size:
+        name, a, b = rng.choice(names), rng.choice(names), rng.choice(names)
+        form = ('(def %s (%s %s)\n'
+                '    (= event (lib.SDL_Event))\n'
+                '    (while (!= 0 (lib.SDL_PollEvent (byref event)))\n'
+                '        (if (== lib.SDL_QUIT event.type)\n'
+                '            (return %s)))\n'
+                '    (stdlib.write stdlib.STDOUT_FILENO "%s" %d)\n'
+                ')\n' % (name, a, b, a, name, rng.randint(0, 1000)))
+        out.append(form)
+        total += len(form)
+    return ''.join(out)
+
+corpora = {
+    'nested': nested,
+    'strings': strings,
+    'symbols': symbols,
+    'comments': comments,
+    'attributes': attributes,
+    'program': program,
+}
+
+def generate(name, size, seed=0):
+    return corpora[name](random.Random(seed), size)
@@ -0,0 +1,116 @@
+from machinecode import VirtualRegister, CellRegister, postorder, writers
+
+# Binds attributes of receivers that are known when the program is
+# built. A variable of the root defn is a constant when it is written
+# once, before anything that may run lisp code, by a call to a uniform
+# native with constant arguments. Such a call is made at build time and
+# every read of the variable, in any defn, is replaced by its value.
+# Attributes of uniform constants are then looked up once, so that
+# (lib.SDL_PollEvent ...) becomes a plain call to the C function.
+# Every value made here is recorded in the root's recipes as the call or
+# getattr that made it, so that a stored program can make it again.
+
+def uniform(obj):
+    return getattr(obj, 'vm_uniform', False)
+
+def isregister(arg):
+    return isinstance(arg, (VirtualRegister, CellRegister))
+
+def bind(closure):
+    root = closure.defn
+    variables = variables_of(root)
+    writes = {}
+    for defn in postorder(root):
+        for block in defn.blocks:
+            for instr in block:
+                if instr[0] in writers:
+                    var = variables.get(instr[1])
+                    writes[var] = writes.get(var, 0) + 1
+    constants = {}
+    entry = root.blocks[0]
+    for i, instr in enumerate(entry):
+        args = [lookup(variables, constants, arg) for arg in instr[2:]]
+        if instr[0] == 'move' and not isregister(args[0]):
+            recipe = None
+        elif (instr[0] == 'call' and uniform(args[0])
+                and not any(isregister(arg) for arg in args)):
+            recipe = ('call',) + tuple(args)
+        elif (instr[0] == 'getattr' and uniform(args[0])
+                and not any(isregister(arg) for arg in args)):
+            recipe = ('getattr', args[0], args[1])
+        elif instr[0] in ('call', 'callattr', 'getattr', 'setattr'):
+            break
+        else:
+            continue
+        # Only values that replace the variable are made, a call left in
+        # place would run again.
+        var = variables.get(instr[1])
+        if var is None or writes.get(var) != 1:
+            continue
+        if recipe is None:
+            value = args[0]
+        else:
+            value = make(root, recipe, entry.sourcemap[i])
+        constants[var] = value
+        entry[i] = ('move', instr[1], value)
+    if len(constants) > 0:
+        for defn in postorder(root):
+            substitute(root, defn, variables, constants)
+    return constants
+
+# Errors are given the location of the instruction, as they would have
+# been when it ran.
+def make(root, recipe, location):
+    try:
+        if recipe[0] == 'call':
+            value = recipe[1].vm_call(list(recipe[2:]))
+        else:
+            value = recipe[1].vm_getattr(recipe[2])
+    except Exception as error:
+        if getattr(error, 'location', None) is None:
+            error.location = location
+        raise
+    root.recipes[id(value)] = (value, recipe)
+    return value
+
+# Maps the registers of the root defn, and the cells that refer to them
+# from nested defns, to the register or cell of the root they stand for.
+def variables_of(root):
+    variables = dict((reg, reg) for reg in root.registers)
+    for reg, cell in root.cells.items():
+        variables[cell] = cell
+    def visit(defn):
+        for block in defn.blocks:
+            for instr in block:
+                if instr[0] != 'closure':
+                    continue
+                nested = instr[2]
+                for index, cell in enumerate(instr[3:]):
+                    var = variables.get(cell)
+                    if var is not None:
+                        variables[nested.cells[nested.freevars[index]]] = var
+                visit(nested)
+    visit(root)
+    return variables
+
+def lookup(variables, constants, arg):
+    if isregister(arg):
+        return constants.get(variables.get(arg), arg)
+    return arg
+
+def substitute(root, defn, variables, constants):
+    for block in defn.blocks:
+        for i, instr in enumerate(block):
+            if instr[0] == 'closure':
+                continue
+            start = 2 if instr[0] in writers else 1
+            args = tuple(lookup(variables, constants, arg) for arg in instr[start:])
+            instr = instr[:start] + args
+            if instr[0] == 'getattr' and bound(instr[2], instr[3]):
+                instr = ('move', instr[1], make(root, ('getattr',) + instr[2:4], block.sourcemap[i]))
+            elif instr[0] == 'callattr' and bound(instr[2], instr[3]):
+                instr = ('call', instr[1], make(root, ('getattr',) + instr[2:4], block.sourcemap[i])) + instr[4:]
+            block[i] = instr
+
+def bound(obj, name):
+    return uniform(obj) and not isregister(obj) and not isregister(name)
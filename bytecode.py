@@ -0,0 +1,219 @@
+from machinecode import VirtualRegister, CellRegister
+
+# Encodes the instructions of a defn for virtualmachine.run. Opcodes are
+# small integers and every operand is an index into the frame's slots:
+# the registers come first, then the constants, then a few scratch slots
+# for cell traffic and a slot for results nobody reads. A frame starts as
+# a copy of the template, so the constants are already in place. Branches
+# hold the target block itself, and a block that runs off its end gets
+# an explicit END.
+
+MOVE, CALL, CALLATTR, GETATTR, SETATTR, CLOSURE, LOADCELL, STORECELL, \
+BRANCH, CBRANCH, RETURN, END, TAILCALL, TAILCALLATTR, \
+CALL_CBRANCH, CALL_BRANCH, CALL_CALL, MOVE_MOVE, MOVE_BRANCH, MOVE_CALL, \
+LOADCELL_CALL, LOADCELL_TAILCALL = range(22)
+
+names = ['move', 'call', 'callattr', 'getattr', 'setattr', 'closure',
+         'loadcell', 'storecell', 'branch', 'cbranch', 'return', 'end',
+         'tailcall', 'tailcallattr',
+         'call/cbranch', 'call/branch', 'call/call', 'move/move', 'move/branch',
+         'move/call', 'loadcell/call', 'loadcell/tailcall']
+
+class Code(object):
+    def __init__(self, defn):
+        self.defn = defn
+        self.template = [None] * len(defn.registers)
+        self.constants = {}
+        self.scratch = []
+        self.discard = None
+        self.blocks = [[] for _ in defn.blocks]
+        self.sourcemaps = [[] for _ in defn.blocks]
+        self.entry = self.blocks[0]
+        self.params = []
+        self.ncells = len(defn.cellvars)
+
+    def constant(self, value):
+        key = id(value)
+        if key not in self.constants:
+            self.constants[key] = len(self.template)
+            self.template.append(value)
+        return self.constants[key]
+
+    def temporary(self, index):
+        while len(self.scratch) <= index:
+            self.scratch.append(len(self.template))
+            self.template.append(None)
+        return self.scratch[index]
+
+    def sink(self):
+        if self.discard is None:
+            self.discard = len(self.template)
+            self.template.append(None)
+        return self.discard
+
+# Turns an instruction into slot operands. Cells are read into scratch
+# slots before it, and a result meant for a cell is stored after it.
+class Encoder(object):
+    def __init__(self, code, block, sourcemap, location):
+        self.code = code
+        self.block = block
+        self.sourcemap = sourcemap
+        self.location = location
+        self.scratch = 0
+        self.after = []
+        self.tail = False
+
+    def emit(self, *instr):
+        self.block.append(instr)
+        self.sourcemap.append(self.location)
+
+    def read(self, arg):
+        if isinstance(arg, VirtualRegister):
+            return arg.index
+        if isinstance(arg, CellRegister):
+            slot = self.code.temporary(self.scratch)
+            self.scratch += 1
+            self.emit(LOADCELL, slot, arg.index)
+            return slot
+        return self.code.constant(arg)
+
+    def write(self, arg):
+        if isinstance(arg, VirtualRegister):
+            return arg.index
+        if isinstance(arg, CellRegister):
+            slot = self.code.temporary(self.scratch)
+            self.scratch += 1
+            self.after.append((STORECELL, arg.index, slot))
+            return slot
+        return self.code.sink()
+
+    def finish(self, *instr):
+        self.emit(*instr)
+        for instr in self.after:
+            self.emit(*instr)
+
+def compile(defn):
+    code = Code(defn)
+    for index, block in enumerate(defn.blocks):
+        dst = code.blocks[index]
+        sourcemap = code.sourcemaps[index]
+        for i, (instr, location) in enumerate(zip(block.instructions, block.sourcemap)):
+            encoder = Encoder(code, dst, sourcemap, location)
+            if tail(defn, block, i):
+                encoder.tail = True
+            if encode(code, encoder, instr):
+                break
+        else:
+            dst.append((END,))
+            sourcemap.append(None)
+    # Arguments bound to cells are stored there on entry.
+    prologue = []
+    for param in defn.params:
+        if isinstance(param, CellRegister):
+            slot = code.temporary(len(code.params))
+            prologue.append((STORECELL, param.index, slot))
+            code.params.append(slot)
+        else:
+            code.params.append(param.index)
+    if len(prologue) > 0:
+        prologue.append((BRANCH, code.entry))
+        code.entry = prologue
+    for block, sourcemap in zip(code.blocks, code.sourcemaps):
+        fuse(block, sourcemap)
+    return code
+
+# A call is in tail position when the next thing its frame does is to
+# return the result, right after it or at the start of the block it
+# branches to. The return stays after the tail call, the interpreter
+# runs it when it can not replace the frame.
+def tail(defn, block, index):
+    instr = block[index]
+    if instr[0] not in ('call', 'callattr') or not isinstance(instr[1], VirtualRegister):
+        return False
+    if index + 1 >= len(block):
+        return False
+    after = block[index+1]
+    if after[0] == 'branch' and len(defn.blocks[after[1]]) > 0:
+        after = defn.blocks[after[1]][0]
+    return after[0] == 'return' and after[1] is instr[1]
+
+# Returns True once the block is terminated.
+def encode(code, encoder, instr):
+    name = instr[0]
+    if name == 'move':
+        src = encoder.read(instr[2])
+        encoder.finish(MOVE, encoder.write(instr[1]), src)
+    elif name == 'call' or name == 'callattr' or name == 'getattr':
+        args = tuple(encoder.read(arg) for arg in instr[2:])
+        if encoder.tail:
+            opcode = {'call': TAILCALL, 'callattr': TAILCALLATTR}[name]
+        else:
+            opcode = {'call': CALL, 'callattr': CALLATTR, 'getattr': GETATTR}[name]
+        encoder.finish(opcode, encoder.write(instr[1]), *args)
+    elif name == 'setattr':
+        args = tuple(encoder.read(arg) for arg in instr[1:])
+        encoder.finish(SETATTR, *args)
+    elif name == 'closure':
+        cells = tuple(cell.index for cell in instr[3:])
+        encoder.finish(CLOSURE, encoder.write(instr[1]), instr[2], cells)
+    elif name == 'branch':
+        encoder.finish(BRANCH, code.blocks[instr[1]])
+        return True
+    elif name == 'cbranch':
+        cond = encoder.read(instr[1])
+        encoder.finish(CBRANCH, cond, code.blocks[instr[2]], code.blocks[instr[3]])
+        return True
+    elif name == 'return':
+        encoder.finish(RETURN, encoder.read(instr[1]))
+        return True
+    else:
+        raise Exception("no such instruction %s" % name)
+    return False
+
+# Superinstructions for the pairs that virtualmachine.profile found most
+# often in a block, on programs with loops, closures and helper calls.
+# Nearly a third of the pairs were a call followed by a cbranch, a branch
+# or another call. A call may enter a closure, so the instruction after
+# it stays in place and runs after the closure returns. The fused
+# instruction runs both halves when the callee is native, and skips the
+# kept one. Pairs that start with a move or loadcell become one.
+def fuse(block, sourcemap):
+    i = 0
+    while i + 1 < len(block):
+        a, b = block[i], block[i+1]
+        if a[0] == CALL and b[0] == CBRANCH and b[1] == a[1]:
+            block[i] = (CALL_CBRANCH, b[2], b[3]) + a[1:]
+            i += 2
+        elif a[0] == CALL and b[0] == BRANCH:
+            block[i] = (CALL_BRANCH, b[1]) + a[1:]
+            i += 2
+        elif a[0] == CALL and b[0] == CALL:
+            block[i] = (CALL_CALL, block, i + 2, a[1:], b[1:])
+            i += 2
+        elif a[0] == MOVE and b[0] in (MOVE, BRANCH, CALL):
+            opcode = {MOVE: MOVE_MOVE, BRANCH: MOVE_BRANCH, CALL: MOVE_CALL}[b[0]]
+            block[i:i+2] = [(opcode,) + a[1:] + b[1:]]
+            del sourcemap[i+1]
+            i += 1
+        elif a[0] == LOADCELL and b[0] in (CALL, TAILCALL):
+            opcode = {CALL: LOADCELL_CALL, TAILCALL: LOADCELL_TAILCALL}[b[0]]
+            block[i:i+2] = [(opcode,) + a[1:] + b[1:]]
+            del sourcemap[i+1]
+            i += 1
+        else:
+            i += 1
+
+def disassemble(code):
+    index = dict((id(block), i) for i, block in enumerate(code.blocks))
+    lines = []
+    for i, block in enumerate(code.blocks):
+        lines.append('%3i:' % i)
+        for instr in block:
+            args = []
+            for arg in instr[1:]:
+                if isinstance(arg, list):
+                    args.append('->%i' % index.get(id(arg), -1))
+                else:
+                    args.append(repr(arg))
+            lines.append('        %s %s' % (names[instr[0]], ' '.join(args)))
+    return '\n'.join(lines)
@@ -0,0 +1,229 @@
+import hashlib, marshal, os, sys
+from lisp import cache, read
+from machinecode import Scope, Defn, VirtualRegister, CellRegister, Closure
+import machinecode
+
+# Compiled programs are stored next to the parsed trees of lisp.cache,
+# under the hash of the source, the compiler version and the passes that
+# ran. A warm start loads the defns without reading or building anything.
+# Constants that marshal cannot hold are stored by name: natives as the
+# name they have in the global scope, and values that binding made at
+# build time as the recipe that made them, which runs again on load.
+# The key takes in the source of every module of the compiler and of
+# the modules the passes come from, so that a changed compiler misses.
+# The version is checked on load and stands for the layout alone.
+version = 1
+
+compiler = ['lisp.read', 'machinecode', 'binding', 'inlining', 'lowering',
+            'machine.analysis', 'machine.block', 'machine.instruction',
+            'peephole', 'regalloc', 'bytecode', 'codecache']
+
+plain = (int, long, float, str, unicode, bool, type(None))
+
+class Unstorable(Exception):
+    pass
+
+def names(scope):
+    table = {}
+    while scope is not None:
+        for name, obj in scope.objects.items():
+            table.setdefault(id(obj), name)
+        scope = scope.parent
+    return table
+
+class Writer(object):
+    def __init__(self, root, scope):
+        self.defns = list(preorder(root))
+        self.index = dict((id(defn), i) for i, defn in enumerate(self.defns))
+        self.globals = names(scope)
+        self.recipes = root.recipes
+        self.made = {}
+        self.steps = []
+        self.paths = []
+        self.pathindex = {}
+
+    def value(self, obj):
+        if isinstance(obj, plain):
+            return ('k', obj)
+        if id(obj) in self.made:
+            return ('x', self.made[id(obj)])
+        if id(obj) in self.recipes:
+            recipe = self.recipes[id(obj)][1]
+            step = (recipe[0],) + tuple(self.value(arg) for arg in recipe[1:])
+            self.made[id(obj)] = len(self.steps)
+            self.steps.append(step)
+            return ('x', self.made[id(obj)])
+        if id(obj) in self.globals:
+            return ('g', self.globals[id(obj)])
+        raise Unstorable(repr(obj))
+
+    def operand(self, defn, arg):
+        if isinstance(arg, VirtualRegister):
+            assert arg.defn is defn
+            return ('r', arg.index)
+        if isinstance(arg, CellRegister):
+            return ('c', arg.index)
+        if isinstance(arg, Defn):
+            return ('d', self.index[id(arg)])
+        return self.value(arg)
+
+    def location(self, location):
+        if location is None:
+            return None
+        start, stop, path = location
+        if path not in self.pathindex:
+            self.pathindex[path] = len(self.paths)
+            self.paths.append(path)
+        return (start, stop, self.pathindex[path])
+
+    def defn(self, defn):
+        if defn.stub is not None:
+            raise Unstorable('deferred defn')
+        parent = self.index.get(id(defn.parent), -1)
+        scope = []
+        for name, reg in defn.scope.objects.items():
+            if not isinstance(reg, VirtualRegister):
+                raise Unstorable(name)
+            scope.append((name, reg.index))
+        blocks = []
+        for block in defn.blocks:
+            instructions = [(instr[0],) + tuple(self.operand(defn, arg) for arg in instr[1:])
+                            for instr in block]
+            sourcemap = [self.location(location) for location in block.sourcemap]
+            blocks.append((instructions, sourcemap))
+        params = [self.operand(defn, param) for param in defn.params]
+        cellvars = [reg.index for reg in defn.cellvars]
+        freevars = [(depth(defn, reg.defn), reg.index) for reg in defn.freevars]
+        return (parent, defn.argc, len(defn.registers), scope, params,
+                cellvars, freevars, blocks)
+
+def preorder(defn):
+    yield defn
+    for block in defn.blocks:
+        for instr in block:
+            if instr[0] == 'closure':
+                for nested in preorder(instr[2]):
+                    yield nested
+
+def depth(defn, owner):
+    count = 0
+    while defn is not owner:
+        defn = defn.parent
+        count += 1
+    return count
+
+def dump(closure, scope):
+    writer = Writer(closure.defn, scope)
+    defns = [writer.defn(defn) for defn in writer.defns]
+    return marshal.dumps((version, writer.steps, writer.paths, defns))
+
+def load(data, scope):
+    check, steps, paths, entries = marshal.loads(data)
+    if check != version:
+        raise ValueError("compiled format %r" % check)
+    made = []
+    def value(tag, arg):
+        if tag == 'k':
+            return arg
+        if tag == 'x':
+            return made[arg]
+        obj = scope.lookup(arg)
+        if obj is None:
+            raise KeyError(arg)
+        return obj
+    for step in steps:
+        args = [value(*arg) for arg in step[1:]]
+        if step[0] == 'call':
+            made.append(args[0].vm_call(args[1:]))
+        else:
+            made.append(args[0].vm_getattr(args[1]))
+    return Closure(unpack(entries, paths, value, scope)[0])
+
+# Makes the defns of the entries, with value() for their constants. An
+# entry whose parent is not among them goes under the given parent, in
+# a scope under the given one.
+def unpack(entries, paths, value, scope, parent=None):
+    defns = []
+    cells = []
+    for up, argc, nregs, names, params, cellvars, freevars, blocks in entries:
+        outer = scope if up < 0 else defns[up].scope
+        defn = Defn(Scope(outer), parent if up < 0 else defns[up])
+        defn.argc = argc
+        for _ in range(nregs):
+            defn.newreg()
+        for name, index in names:
+            defn.scope.objects[read.symbol(name)] = defn.registers[index]
+        defn.cellvars = [defn.registers[index] for index in cellvars]
+        defn.freevars = []
+        for count, index in freevars:
+            owner = defn
+            for _ in range(count):
+                owner = owner.parent
+            defn.freevars.append(owner.registers[index])
+        cellregs = [CellRegister(defn, index)
+                    for index in range(len(cellvars) + len(freevars))]
+        for reg, cell in zip(defn.cellvars + defn.freevars, cellregs):
+            defn.cells[reg] = cell
+        defn.blocks = blocks
+        defn.params = params
+        defns.append(defn)
+        cells.append(cellregs)
+    for defn, cellregs in zip(defns, cells):
+        def operand(arg):
+            tag, arg = arg
+            if tag == 'r':
+                return defn.registers[arg]
+            if tag == 'c':
+                return cellregs[arg]
+            if tag == 'd':
+                return defns[arg]
+            return value(tag, arg)
+        blocks, defn.blocks = defn.blocks, []
+        for instructions, sourcemap in blocks:
+            block = defn.newblock()
+            for instr, location in zip(instructions, sourcemap):
+                if location is not None:
+                    location = (location[0], location[1], paths[location[2]])
+                block.append((instr[0],) + tuple(operand(arg) for arg in instr[1:]), location)
+        defn.params = [operand(param) for param in defn.params]
+    return defns
+
+# Hashes of the sources of modules, by module name.
+digests = {}
+
+def digest(name):
+    if name not in digests:
+        __import__(name)
+        path = sys.modules[name].__file__
+        if path.endswith(('.pyc', '.pyo')):
+            path = path[:-1]
+        with open(path, 'rb') as fd:
+            digests[name] = hashlib.sha1(fd.read()).hexdigest()
+    return digests[name]
+
+def key(source, passes, program):
+    fns = list(program) + list(passes)
+    names = ','.join('%s.%s' % (fn.__module__, fn.__name__) for fn in fns)
+    modules = sorted(set(compiler) | set(fn.__module__ for fn in fns))
+    sources = ','.join(digest(name) for name in modules)
+    return hashlib.sha1('compiled:%d:%s:%s:%s' % (version, names, sources, source)).hexdigest()
+
+# Builds the program in path, or loads it if it was built before.
+def build(path, scope, macros, passes=(), program=()):
+    with open(path, 'rb') as fd:
+        source = fd.read()
+    entry = os.path.join(cache.directory, key(source, passes, program))
+    try:
+        with open(entry, 'rb') as fd:
+            closure = load(fd.read(), scope)
+        os.utime(entry, None)
+        return closure
+    except Exception:
+        pass # missing, stale or corrupt entries are built again
+    closure = machinecode.build(read.string(source, path), scope, macros, passes, program)
+    try:
+        data = dump(closure, scope)
+    except Unstorable:
+        return closure
+    cache.store(entry, data)
+    return closure
@@ -158,7 +158,11 @@ class CFunc(object):
     def vm_call(self, argv):
         return self.fn(*argv)
 
+# The declarations of a library do not change, so the attributes of a
+# CDLL bound at build time may be looked up right then.
 class CDLL(object):
+    vm_uniform = True
+
     def __init__(self, path, *headers):
         self.path = path
         self.headers = [Header(header) for header in headers]
@@ -0,0 +1,96 @@
+import hashlib, marshal, os
+from lisp import cache, read
+from machinecode import Closure, build_defn
+import codecache, parallel
+
+# Rebuilds a program with the results of its last build. Reading, the
+# build and the program passes are cheap next to the defn passes, so
+# they run as usual. Then every tree of a top-level defn becomes the
+# task parallel would send out, and a task seen in the last build takes
+# the result it had then. A task is the code of the form after the
+# program passes, so it changes with the form and with what it took
+# from the forms it depends on: the constants bound into it, the callees
+# inlined into it and the registers of the root it captures. Locations
+# are taken from the start of the form and the captured registers are
+# numbered in the order the tree captures them, so that an edit in
+# another form leaves the task as it was. One entry per program and
+# passes holds the results of the last build, by the hash of the task.
+version = 1
+
+def key(path, passes, program):
+    return codecache.key('incremental:%d:%s' % (version, os.path.abspath(path)), passes, program)
+
+# Moves the locations of a tree by the offset and renumbers the root
+# registers it captures, with number() for each index.
+def rewrite(data, offset, number):
+    paths, entries = marshal.loads(data)
+    levels = []
+    for i, entry in enumerate(entries):
+        up, freevars, blocks = entry[0], entry[6], entry[7]
+        level = 0 if up < 0 else levels[up] + 1
+        levels.append(level)
+        freevars = [(count, number(index) if count == level + 1 else index)
+                    for count, index in freevars]
+        blocks = [(instructions, [None if location is None
+                                  else (location[0] + offset, location[1] + offset, location[2])
+                                  for location in sourcemap])
+                  for instructions, sourcemap in blocks]
+        entries[i] = entry[:6] + (freevars, blocks)
+    return marshal.dumps((paths, entries))
+
+def relative(data, base):
+    captured = []
+    numbers = {}
+    def number(index):
+        if index not in numbers:
+            numbers[index] = len(captured)
+            captured.append(index)
+        return numbers[index]
+    return rewrite(data, -base, number), captured
+
+def absolute(data, base, captured):
+    return rewrite(data, base, captured.__getitem__)
+
+def load(entry):
+    try:
+        with open(entry, 'rb') as fd:
+            check, results = marshal.loads(fd.read())
+        if check == version:
+            os.utime(entry, None)
+            return results
+    except Exception:
+        pass # missing, stale or corrupt entries start over
+    return {}
+
+# Misses go to the pool when there is one, see parallel.start.
+def build(path, scope, macros, passes=(), program=(), pool=None):
+    entry = os.path.join(cache.directory, key(path, passes, program))
+    results = load(entry)
+    closure = Closure(build_defn([], read.file(path), scope, macros))
+    for run in program:
+        run(closure)
+    root = closure.defn
+    jobs, tasks, tables = parallel.split(root)
+    digests = []
+    moves = []
+    missing = {}
+    for (block, index), (uniform, data) in zip(jobs, tasks):
+        location = block.sourcemap[index]
+        base = 0 if location is None else location[0]
+        data, captured = relative(data, base)
+        digest = hashlib.sha1(marshal.dumps((uniform, data))).hexdigest()
+        if digest not in results:
+            missing[digest] = (uniform, data)
+        digests.append(digest)
+        moves.append((base, captured))
+    order = list(missing)
+    if pool is None:
+        done = [parallel.refine(missing[digest], passes) for digest in order]
+    else:
+        done = pool.map(parallel.optimize, [missing[digest] for digest in order])
+    results.update(zip(order, done))
+    parallel.join(root, jobs, tables, [absolute(results[digest], base, captured)
+        for digest, (base, captured) in zip(digests, moves)], passes)
+    cache.store(entry, marshal.dumps((version, dict(
+        (digest, results[digest]) for digest in digests))))
+    return closure
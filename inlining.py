@@ -0,0 +1,134 @@
+from machinecode import VirtualRegister, postorder, writers
+from binding import variables_of
+from regalloc import liveness, reachable
+
+# Copies small defns into the blocks of their callers. A callee is known
+# when a variable is written once, by a closure instruction in the entry
+# block of the defn that owns it. Calls that run after that instruction
+# always see the closure: the ones later in the owner, and every call in
+# a defn made by a closure instruction later in the owner. Only callees
+# that capture nothing and make no closures are copied, so they can not
+# call themselves either. The call becomes moves into fresh registers and
+# a branch into the copy, whose returns move the value into the result
+# and branch to the rest of the block.
+
+# Instructions in a callee, and instructions added to one caller.
+budget = 16
+growth = 160
+
+def inline(closure):
+    sites = {}
+    for owner in postorder(closure.defn):
+        variables = variables_of(owner)
+        callees = dict((var, (index, callee))
+                       for var, index, callee in known(owner, variables))
+        if len(callees) == 0:
+            continue
+        for defn, site, var in calls(owner, variables, callees):
+            sites.setdefault(defn, {})[site] = callees[var][1]
+    for defn, calls_of in sites.items():
+        added = 0
+        for site in sorted(calls_of, reverse=True):
+            callee = calls_of[site]
+            if added + size(callee) > growth:
+                continue
+            block = defn.blocks[site[0]]
+            if len(block[site[1]]) - 3 > callee.argc:
+                continue
+            splice(defn, block, site[1], callee)
+            added += size(callee)
+
+# Variables of the owner bound to a small callee, with the index of the
+# closure instruction in the entry block.
+def known(owner, variables):
+    writes = {}
+    for defn in postorder(owner):
+        for block in defn.blocks:
+            for instr in block:
+                if instr[0] in writers:
+                    var = variables.get(instr[1])
+                    writes[var] = writes.get(var, 0) + 1
+    for index, instr in enumerate(owner.blocks[0]):
+        if instr[0] != 'closure' or len(instr) > 3:
+            continue
+        var = variables.get(instr[1])
+        if var is not None and writes[var] == 1 and small(instr[2]):
+            yield var, index, instr[2]
+
+def small(callee):
+    if len(callee.cellvars) > 0 or len(callee.freevars) > 0:
+        return False
+    for block in callee.blocks:
+        for instr in block:
+            if instr[0] == 'closure':
+                return False
+    return size(callee) <= budget
+
+def size(callee):
+    return sum(len(reachable(block)) for block in callee.blocks)
+
+# Calls through the known variables that run after their closure
+# instruction, found in one walk over the owner.
+def calls(owner, variables, callees):
+    def after(var, block, index):
+        return block.index > 0 or index > callees[var][0]
+    for block in owner.blocks:
+        for index, instr in enumerate(block):
+            if instr[0] == 'call':
+                var = variables.get(instr[2])
+                if var in callees and after(var, block, index):
+                    yield owner, (block.index, index), var
+            if instr[0] == 'closure':
+                for defn in postorder(instr[2]):
+                    for nested in defn.blocks:
+                        for i, call in enumerate(nested):
+                            if call[0] != 'call':
+                                continue
+                            var = variables.get(call[2])
+                            if var in callees and after(var, block, index):
+                                yield defn, (nested.index, i), var
+
+def splice(defn, block, index, callee):
+    instr = block[index]
+    location = block.sourcemap[index]
+    dst = instr[1]
+    cont = defn.newblock()
+    for rest, loc in zip(block.instructions[index+1:], block.sourcemap[index+1:]):
+        cont.append(rest, loc)
+    del block.instructions[index:]
+    del block.sourcemap[index:]
+    regs = dict((reg, defn.newreg()) for reg in callee.registers)
+    def rename(arg):
+        if isinstance(arg, VirtualRegister):
+            return regs[arg]
+        return arg
+    blocks = [defn.newblock().index for _ in callee.blocks]
+    # A frame starts with every register None, so the ones the callee
+    # may read before writing are cleared, like the missing arguments.
+    argv = list(instr[3:])
+    argv.extend([None] * (len(callee.params) - len(argv)))
+    for param, arg in zip(callee.params, argv):
+        block.append(('move', regs[param], arg), location)
+    livein = liveness(callee)[0][0]
+    for reg in callee.registers:
+        if reg in livein and reg not in callee.params:
+            block.append(('move', regs[reg], None), location)
+    block.append(('branch', blocks[0]), location)
+    for src, index in zip(callee.blocks, blocks):
+        copy = defn.blocks[index]
+        for instr, loc in zip(reachable(src), src.sourcemap):
+            if instr[0] == 'return':
+                copy.append(('move', dst, rename(instr[1])), loc)
+                copy.append(('branch', cont.index), loc)
+            elif instr[0] == 'branch':
+                copy.append(('branch', blocks[instr[1]]), loc)
+            elif instr[0] == 'cbranch':
+                copy.append(('cbranch', rename(instr[1]),
+                    blocks[instr[2]], blocks[instr[3]]), loc)
+            else:
+                copy.append(tuple(rename(arg) for arg in instr), loc)
+                continue
+            break
+        else:
+            copy.append(('move', dst, None), location)
+            copy.append(('branch', cont.index), location)
@@ -0,0 +1,130 @@
+import gc, hashlib, itertools, marshal, os
+import read
+
+# Parsed trees are stored under the hash of the source they came from,
+# so an edited file simply misses. Bump the version when the layout of
+# the stored data changes.
+version = 1
+directory = os.path.join(os.path.expanduser('~'), '.cache', 'lisp')
+limit = 64 << 20
+
+codes = {'list': 'l', 'string': 's', 'symbol': 'y', 'number': 'n'}
+names = dict((code, name) for name, code in codes.items())
+
+# The tree is flattened in postorder into one character per node, a
+# value per node (the text, or the child count of a list) and the packed
+# spans. An attribute with a captured object comes after that object.
+def dump(tree):
+    kinds = []
+    values = []
+    spans = []
+    nodes = [tree]
+    while len(nodes) > 0:
+        node = nodes.pop()
+        spans.append(node.span)
+        if node.name == 'list':
+            kinds.append('l')
+            values.append(len(node.value))
+            nodes.extend(node.value)
+        elif node.name == 'attribute':
+            name, capture = node.value
+            values.append(name)
+            if capture is None:
+                kinds.append('b')
+            else:
+                kinds.append('a')
+                nodes.append(capture)
+        else:
+            kinds.append(codes[node.name])
+            values.append(node.value)
+    kinds.reverse()
+    values.reverse()
+    spans.reverse()
+    return marshal.dumps((version, ''.join(kinds), values, spans))
+
+# Nodes never form cycles, so the collector is paused while they are
+# created. Otherwise it would rescan the growing tree over and over.
+def load(data, fileid):
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return unpack(data, fileid)
+    finally:
+        if enabled:
+            gc.enable()
+
+def unpack(data, fileid):
+    check, kinds, values, spans = marshal.loads(data)
+    if check != version:
+        raise ValueError("cache format %r" % check)
+    Node = read.Node
+    symbol = read.symbol
+    stack = []
+    push = stack.append
+    for kind, value, span in itertools.izip(kinds, values, spans):
+        if kind == 'y':
+            push(Node('symbol', symbol(value), span, fileid))
+        elif kind == 'l':
+            if value > 0:
+                children = stack[-value:]
+                del stack[-value:]
+            else:
+                children = []
+            push(Node('list', children, span, fileid))
+        elif kind == 'a':
+            push(Node('attribute', [symbol(value), stack.pop()], span, fileid))
+        elif kind == 'b':
+            push(Node('attribute', [symbol(value), None], span, fileid))
+        else:
+            push(Node(names[kind], value, span, fileid))
+    if len(stack) != 1:
+        raise ValueError("truncated cache entry")
+    return stack[0]
+
+def key(source):
+    return hashlib.sha1('%d:%s' % (version, source)).hexdigest()
+
+def file(path):
+    with open(path, 'rb') as fd:
+        source = fd.read()
+    entry = os.path.join(directory, key(source))
+    try:
+        with open(entry, 'rb') as fd:
+            tree = load(fd.read(), read.fileid(path))
+        if tree.span == read.span(0, len(source)):
+            os.utime(entry, None)
+            return tree
+    except Exception:
+        pass # missing, stale or corrupt entries are parsed again
+    tree = read.string(source, path)
+    store(entry, dump(tree))
+    return tree
+
+def store(entry, data):
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp = '%s.%d' % (entry, os.getpid())
+        with open(temp, 'wb') as fd:
+            fd.write(data)
+        os.rename(temp, entry)
+        evict()
+    except (IOError, OSError):
+        pass # the cache is only an optimization
+
+# Removes the least recently used entries until the directory fits in
+# the limit. Loads touch their entry, so mtime tracks the last use.
+def evict():
+    entries = []
+    total = 0
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        stat = os.stat(path)
+        entries.append((stat.st_mtime, stat.st_size, path))
+        total += stat.st_size
+    entries.sort()
+    for mtime, size, path in entries:
+        if total <= limit:
+            break
+        os.remove(path)
+        total -= size
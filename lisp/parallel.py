@@ -0,0 +1,99 @@
+import mmap, os
+import cache, read
+
+# Parses large sources in a process pool. A prescan finds top-level form
+# boundaries, the chunks between them are parsed by the workers, and the
+# parent stitches the forms back into one list node. Workers send their
+# forms back in the compact cache encoding, which is cheaper to load than
+# pickled nodes and gets the parent's file id on the way in.
+
+chunksize = 1 << 18
+
+# Returns the offsets where the source can be cut, or None when the
+# source is malformed, so that a serial parse reports the failure.
+def prescan(source, size=chunksize):
+    cuts = []
+    depth = 0
+    last = 0
+    for m in read.structure.finditer(source):
+        ch = m.group()[0]
+        if ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth -= 1
+            if depth < 0:
+                return None
+            if depth == 0 and m.end() - last >= size:
+                # An attribute after the form would capture it.
+                after = read.blank.match(source, m.end()).end()
+                if after == len(source) or source[after] != '.':
+                    last = m.end()
+                    cuts.append(last)
+        elif ch in ('"', "'"):
+            if m.end() - m.start() < 2 or m.group()[-1] != ch:
+                return None
+    if depth > 0:
+        return None
+    return cuts
+
+def parse((path, source, start, stop)):
+    if source is None:
+        with open(path, 'rb') as fd:
+            source = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        forms = list(read.scan(source, path, start, stop))
+        source.close()
+    else:
+        forms = list(read.scan(source, path))
+        for node in forms:
+            read.shift(node, start)
+    return cache.dump(read.Node('list', forms, 0, 0))
+
+def chunks(cuts, size):
+    bounds = [0] + cuts + [size]
+    return zip(bounds[:-1], bounds[1:])
+
+def stitch(path, size, results):
+    fileid = read.fileid(path)
+    forms = []
+    for data in results:
+        forms.extend(cache.load(data, fileid).value)
+    return read.Node('list', forms, read.span(0, size), fileid)
+
+def string(source, path, pool, size=chunksize):
+    cuts = prescan(source, size)
+    if cuts is None:
+        return read.table(source, path)
+    tasks = [(path, source[start:stop], start, stop)
+             for start, stop in chunks(cuts, len(source))]
+    return stitch(path, len(source), pool.map(parse, tasks))
+
+def file(path, pool, size=chunksize):
+    return files([path], pool, size)[0]
+
+# All chunks of all files go into the pool at once.
+def files(paths, pool, size=chunksize):
+    tasks = []
+    counts = []
+    sizes = []
+    for path in paths:
+        with open(path, 'rb') as fd:
+            length = os.fstat(fd.fileno()).st_size
+            if length > 0:
+                source = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+                cuts = prescan(source, size)
+                source.close()
+        sizes.append(length)
+        if length == 0:
+            counts.append(0)
+            continue
+        if cuts is None:
+            read.file(path) # raises the failure
+        bounds = chunks(cuts, length)
+        tasks.extend((path, None, start, stop) for start, stop in bounds)
+        counts.append(len(bounds))
+    results = pool.map(parse, tasks)
+    trees = []
+    for path, count, length in zip(paths, counts, sizes):
+        trees.append(stitch(path, length, results[:count]))
+        results = results[count:]
+    return trees
@@ -1,13 +1,48 @@
+import mmap, os, re, sys
+
 class Failure(Exception):
     def __init__(self, message, location):
+        Exception.__init__(self, message, location)
         self.message = message
         self.location = location
 
+# Paths are stored once in this table, nodes only carry the index.
+paths = []
+fileids = {}
+
+def fileid(path):
+    if path not in fileids:
+        fileids[path] = len(paths)
+        paths.append(path)
+    return fileids[path]
+
+# A span packs the start and stop offsets of a node into one integer.
+def span(start, stop):
+    return start << 32 | stop
+
 class Node(object):
-    def __init__(self, name, value, location):
+    __slots__ = ('name', 'value', 'span', 'fileid')
+    def __init__(self, name, value, span, fileid):
         self.name = name
         self.value = value
-        self.location = location
+        self.span = span
+        self.fileid = fileid
+
+    @property
+    def start(self):
+        return self.span >> 32
+
+    @property
+    def stop(self):
+        return self.span & 0xFFFFFFFF
+
+    @property
+    def path(self):
+        return paths[self.fileid]
+
+    @property
+    def location(self):
+        return (self.span >> 32, self.span & 0xFFFFFFFF, paths[self.fileid])
 
     def __len__(self):
         return len(self.value)
@@ -21,10 +56,22 @@ class Node(object):
     def __repr__(self):
         return 'Node(%r, %r, %r)' % (self.name, self.value, self.location)
 
+# Symbols and attribute names are interned, so equal names read from
+# anywhere share one object and scope lookups mostly compare identities.
+symbols = {}
+
+def symbol(name):
+    if type(name) is str:
+        return intern(name)
+    return symbols.setdefault(name, name)
+
+def node(name, value, (start, stop, path)):
+    return Node(name, value, span(start, stop), fileid(path))
+
 class Reader(object):
     def create(self, name, location, value=None):
         value = self.value if value is None else value
-        self.parent.value.append(Node(name, value, location))
+        self.parent.value.append(node(name, value, location))
         return self.parent
 
 class List(Reader):
@@ -54,7 +101,7 @@ class List(Reader):
 
     def done(self, index, loc):
         if self.parent is None:
-            return Node('list', self.value, loc(self.start, index))
+            return node('list', self.value, loc(self.start, index))
         raise Failure('missing right parenthesis', loc(self.start, self.start+1))
 
 class Number(Reader):
@@ -102,11 +149,11 @@ class Symbol(Reader):
             return self
         else:
             location = loc(self.start, index)
-            return self.create('symbol', location)(index, ch, loc)
+            return self.create('symbol', location, symbol(self.value))(index, ch, loc)
 
     def done(self, index, loc):
         location = loc(self.start, index)
-        return self.create('symbol', location).done(index, loc)
+        return self.create('symbol', location, symbol(self.value)).done(index, loc)
 
 class Attribute(Reader):
     def __init__(self, parent, start, value):
@@ -123,12 +170,12 @@ class Attribute(Reader):
             self.value += ch
             return self
         else:
-            value = [self.value, self.capture()]
+            value = [symbol(self.value), self.capture()]
             location = loc(self.start, index)
             return self.create('attribute', location, value)(index, ch, loc)
 
     def done(self, index, loc):
-        value = [self.value, self.capture()]
+        value = [symbol(self.value), self.capture()]
         location = loc(self.start, index)
         return self.create('attribute', location, value).done(index, loc)
 
@@ -145,16 +192,254 @@ class Comment(Reader):
     def done(self, index, loc):
         return self.parent.done(index, loc)
 
-def string(source, path):
+def statemachine(source, path):
     loc = lambda start, stop: (start, stop, path)
     reader = List(None, 0)
     for j, ch in enumerate(source):
         reader = reader(j, ch, loc)
     return reader.done(len(source), loc)
 
-def file(path):
+# The table engine matches whole tokens with one regex and slices them
+# out of the source, instead of feeding the states above one character
+# at a time. The token classes mirror the states: isspace, isdigit and
+# isalnum become \s, \d and [^\W_] (unicode sources use re.UNICODE).
+# Under re.UNICODE \d takes only the decimal digits, while isdigit also
+# takes superscripts, circled numbers and the like, so those are added
+# to the class a number starts with. The ranges are the ones in the
+# Unicode 5.2 data of Python 2.7, and the other classes agree as is.
+pattern = r"""
+    (\s+|\#[^\n]*)          # 1 whitespace and comments
+  | (\()                    # 2 open list
+  | (\))                    # 3 close list
+  | ("[^"]*"|'[^']*')       # 4 string
+  | ([\d%s](?:[^\W_]|\.)*)  # 5 number
+  | (\.[^\s\#()"'.]*)       # 6 attribute
+  | ([^\s\#()"'.]+)         # 7 symbol
+"""
+digits = [
+    (0xb2, 0xb3), (0xb9, 0xb9), (0x1369, 0x1371), (0x2070, 0x2070),
+    (0x2074, 0x2079), (0x2080, 0x2089), (0x2460, 0x2468), (0x2474, 0x247c),
+    (0x2488, 0x2490), (0x24ea, 0x24ea), (0x24f5, 0x24fd), (0x24ff, 0x24ff),
+    (0x2776, 0x277e), (0x2780, 0x2788), (0x278a, 0x2792), (0x10a40, 0x10a43),
+    (0x10e60, 0x10e68), (0x1f100, 0x1f10a)]
+# A narrow build can not hold the characters above the BMP in a class.
+extra = u''.join(u'%s-%s' % (unichr(start), unichr(stop))
+                 for start, stop in digits if stop <= sys.maxunicode)
+tokens = {
+    False: re.compile(pattern % '', re.VERBOSE),
+    True: re.compile(unicode(pattern) % extra, re.VERBOSE | re.UNICODE),
+}
+
+# Everything that can change the nesting depth. Other tokens never hold
+# these characters, so the matches can be taken in isolation.
+structure = re.compile(r"""[()]|"[^"]*"?|'[^']*'?|\#[^\n]*""")
+blank = re.compile(r"""(?:\s+|\#[^\n]*)*""")
+
+# Finds the parenthesis that closes the list open at index, or returns
+# None if the source ends or a string is left open before it.
+def skip(source, index, stop):
+    depth = 1
+    for m in structure.finditer(source, index, stop):
+        ch = source[m.start()]
+        if ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth -= 1
+            if depth == 0:
+                return m.start()
+        elif ch != '#':
+            if m.end() - m.start() < 2 or source[m.end()-1] != ch:
+                return None
+    return None
+
+# The children of a (def ...) list read in lazy mode. The name and the
+# argument list are read right away, the body is scanned only when it
+# is first needed.
+class Lazy(object):
+    __slots__ = ('head', 'items', 'source', 'path', 'start', 'stop', 'delta')
+    def __init__(self, head, source, path, start, stop):
+        self.head = head
+        self.items = None
+        self.source = source
+        self.path = path
+        self.start = start
+        self.stop = stop
+        self.delta = 0
+
+    def materialize(self):
+        if self.items is None:
+            body = list(scan(self.source, self.path, self.start, self.stop))
+            if self.delta != 0:
+                for node in body:
+                    shift(node, self.delta)
+            self.items = self.head + body
+            self.source = None
+        return self.items
+
+    def __len__(self):
+        return len(self.materialize())
+
+    def __iter__(self):
+        return iter(self.materialize())
+
+    def __getitem__(self, index):
+        if self.items is None and isinstance(index, int) and 0 <= index < len(self.head):
+            return self.head[index]
+        return self.materialize()[index]
+
+    def __repr__(self):
+        return repr(self.materialize())
+
+def scan(source, path, index=0, stop=None, lazy=False):
+    match = tokens[type(source) is unicode].match
+    stack = []
+    value = []
+    start = index
+    stop = len(source) if stop is None else stop
+    fid = fileid(path)
+    sym = symbol if type(source) is unicode else intern
+    while index < stop:
+        m = match(source, index)
+        if m is None:
+            raise Failure("unterminated string", (index, stop, path))
+        kind = m.lastindex
+        end = m.end()
+        if kind == 1:
+            pass
+        elif kind == 6:
+            capture = value.pop(-1) if value else None
+            node = Node('attribute', [sym(m.group()[1:]), capture], index << 32 | end, fid)
+            value.append(node)
+        else:
+            # A finished top-level form is held back until the next token
+            # shows that no attribute is going to capture it.
+            if value and not stack:
+                yield value.pop()
+            if kind == 7:
+                value.append(Node('symbol', sym(m.group()), index << 32 | end, fid))
+            elif kind == 2:
+                stack.append((start, value))
+                start = index
+                value = []
+            elif kind == 3:
+                if not stack:
+                    raise Failure('missing left parenthesis', (index, end, path))
+                node = Node('list', value, start << 32 | end, fid)
+                start, value = stack.pop()
+                value.append(node)
+                # The argument list of a def just closed, skip its body.
+                if lazy and len(value) == 3 and value[0].name == 'symbol' and value[0].value == 'def':
+                    close = skip(source, end, stop)
+                    after = blank.match(source, end).end()
+                    if close is not None and source[after] != '.':
+                        body = Lazy(value, source, path, end, close)
+                        end = close + 1
+                        node = Node('list', body, start << 32 | end, fid)
+                        start, value = stack.pop()
+                        value.append(node)
+            elif kind == 4:
+                value.append(Node('string', m.group(), index << 32 | end, fid))
+            else:
+                value.append(Node('number', m.group(), index << 32 | end, fid))
+        index = end
+    if stack:
+        raise Failure('missing right parenthesis', (start, start+1, path))
+    for node in value:
+        yield node
+
+def table(source, path):
+    return node('list', list(scan(source, path)), (0, len(source), path))
+
+def lazy(source, path):
+    return node('list', list(scan(source, path, lazy=True)), (0, len(source), path))
+
+# The leftmost offset of a top-level form. An attribute node spans only
+# its name, the object it captured lies before it.
+def extent(node):
+    while node.name == 'attribute' and node.value[1] is not None:
+        node = node.value[1]
+    return node.start
+
+def shift(node, delta):
+    offset = delta * 0x100000001 # adds delta to both halves of the span
+    nodes = [node]
+    while len(nodes) > 0:
+        node = nodes.pop()
+        node.span += offset
+        if isinstance(node.value, Lazy) and node.value.items is None:
+            node.value.delta += delta
+            nodes.extend(node.value.head)
+        elif node.name == 'list':
+            nodes.extend(node.value)
+        elif node.name == 'attribute' and node.value[1] is not None:
+            nodes.append(node.value[1])
+
+# Rereads only the top-level forms that an edit touches. The edit
+# replaced source[start:stop] of the buffer that produced the tree, and
+# source is the buffer after it. Forms after the edit are reused from
+# the tree and shifted in place, so the old tree should not be used
+# afterwards.
+def reparse(tree, source, start, stop):
+    forms = tree.value
+    path = tree.path
+    delta = len(source) - tree.stop
+    # The first form that ends at or after the edit. The form before it
+    # is reread too, as text inserted after it may start an attribute.
+    lo, hi = 0, len(forms)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if forms[mid].stop < start:
+            lo = mid + 1
+        else:
+            hi = mid
+    first = max(lo - 1, 0)
+    index = extent(forms[first]) if lo > 0 else 0
+    value = forms[:first]
+    reuse = lo
+    reader = scan(source, path, index)
+    for node in reader:
+        position = extent(node) - delta
+        if position >= stop:
+            while reuse < len(forms) and extent(forms[reuse]) < position:
+                reuse += 1
+            if reuse < len(forms) and extent(forms[reuse]) == position:
+                reader.close()
+                for node in forms[reuse:]:
+                    shift(node, delta)
+                    value.append(node)
+                break
+        value.append(node)
+    return Node('list', value, span(0, len(source)), tree.fileid)
+
+engines = {
+    'state': statemachine,
+    'table': table,
+    'lazy': lazy,
+}
+default = 'table'
+
+def string(source, path, engine=None):
+    return engines[engine or default](source, path)
+
+def file(path, engine=None):
     with open(path) as fd:
-        return string(fd.read(), path)
+        return string(fd.read(), path, engine)
+
+# Yields the top-level forms of a file one at a time, scanning a memory
+# mapped view of it, so the caller can compile each form as it arrives.
+# Lazy def bodies keep reading from the map, so in lazy mode it is left
+# for the collector to close.
+def stream(path, lazy=False):
+    with open(path, 'rb') as fd:
+        if os.fstat(fd.fileno()).st_size == 0:
+            return
+        source = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        for node in scan(source, path, lazy=lazy):
+            yield node
+    finally:
+        if not lazy:
+            source.close()
 
 if __name__=='__main__':
     import sourcelines, sys
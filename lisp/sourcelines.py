@@ -1,61 +1,84 @@
+import bisect, os
+
 HEADER = '\033[95m'
 OKBLUE = '\033[94m'
 WARNING = '\033[93m'
 FAIL = '\033[91m'
 ENDC = '\033[0m'
 
-def plain((start, stop, path)):
-    with open(path) as fd:
-        lines = fd.readlines()
-    k1 = 0
+# Each file is read once and indexed by the offsets where its lines
+# start. The index is dropped when the file's size or mtime changes.
+class Lines(object):
+    def __init__(self, path, stamp):
+        self.path = path
+        self.stamp = stamp
+        with open(path) as fd:
+            self.text = fd.read()
+        self.offsets = offsets = [0]
+        find = self.text.find
+        k = find('\n')
+        while k >= 0:
+            offsets.append(k + 1)
+            k = find('\n', k + 1)
+
+    # Zero-based line number and column of an offset.
+    def locate(self, offset):
+        lineno = bisect.bisect_right(self.offsets, offset) - 1
+        return lineno, offset - self.offsets[lineno]
+
+    def line(self, lineno):
+        start = self.offsets[lineno]
+        if lineno + 1 < len(self.offsets):
+            return self.text[start:self.offsets[lineno+1]].rstrip('\r\n')
+        return self.text[start:].rstrip('\r\n')
+
+    def lines(self, (start, stop, path)):
+        first, col0 = self.locate(start)
+        last, col1 = self.locate(max(start, stop - 1))
+        return first, col0, last, col1 + (stop > start)
+
+indexes = {}
+
+def index(path):
+    stat = os.stat(path)
+    stamp = (stat.st_size, stat.st_mtime)
+    lines = indexes.get(path)
+    if lines is None or lines.stamp != stamp:
+        lines = indexes[path] = Lines(path, stamp)
+    return lines
+
+# One-based line and column range of a (start, stop, path) location.
+def span(location):
+    first, col0, last, col1 = index(location[2]).lines(location)
+    return (first + 1, col0 + 1), (last + 1, col1 + 1)
+
+def plain(location):
+    lines = index(location[2])
+    first, col0, last, col1 = lines.lines(location)
     res = []
-    for lineno, line in enumerate(lines, 1):
-        k0 = k1
-        k1 += len(line)
-        line = line.strip('\r\n')
-        include = False
-
-        print line, k0, stop, k1,  k0 <= stop < k1
-        print line, k0, start, k1, k0 <= start < k1
-        if k0 <= stop <= k1:
-            include = True
-        if k0 <= start <= k1:
-            include = True
-        if start <= k0 and k1 <= stop:
-            include = True
-
-        if include:
-            fmt = " %3i  %s"
-            res.append(fmt % (lineno, line))
+    for lineno in range(first, last + 1):
+        fmt = " %3i  %s"
+        res.append(fmt % (lineno + 1, lines.line(lineno)))
     return '\n'.join(res)
 
-def color((start, stop, path), color=FAIL):
-    with open(path) as fd:
-        lines = fd.readlines()
-    k1 = 0
+def color(location, color=FAIL):
+    lines = index(location[2])
+    first, col0, last, col1 = lines.lines(location)
     res = []
-    for lineno, line in enumerate(lines, 1):
-        k0 = k1
-        k1 += len(line)
-        line = line.strip('\r\n')
-        include = False
-
-        if k0 <= stop <= k1:
-            cut = stop - k0
-            line = line[:cut] + ENDC + line[cut:]
-            include = True
+    for lineno in range(first, last + 1):
+        line = lines.line(lineno)
+        if lineno == last:
+            line = line[:col1] + ENDC + line[col1:]
         else:
             line = line + ENDC
-        if k0 <= start <= k1:
-            cut = start - k0
-            line = line[:cut] + color + line[cut:]
-            include = True
+        if lineno == first:
+            line = line[:col0] + color + line[col0:]
         else:
             line = color + line
-        if start <= k0 and k1 <= stop:
-            include = True
-
-        if include:
-            fmt = HEADER+" %3i"+ENDC+"  %s"
-            res.append(fmt % (lineno, line))
+        fmt = HEADER+" %3i"+ENDC+"  %s"
+        res.append(fmt % (lineno + 1, line))
     return '\n'.join(res)
+
+# Renders many diagnostics at once, every file is indexed only once.
+def batch(locations, highlight=FAIL):
+    return [color(location, highlight) for location in locations]
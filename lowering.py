@@ -0,0 +1,338 @@
+from machinecode import VirtualRegister, CellRegister
+from machine.block import Block, Builder, Instruction, unbound
+from machine import analysis
+from regalloc import temporaries
+
+# Lowers a defn into the machine/ IR, runs passes over it and lowers the
+# result back into VM instructions. Every register becomes a label: an
+# instruction that writes a register carries its label, and reads go
+# through unbound(label). Cells are memory to the IR, they are read and
+# written with loadcell and storecell. An instruction without a label
+# keeps its result in a register of its own.
+
+class Function(object):
+    def __init__(self, defn):
+        self.defn = defn
+        self.entry = None
+        self.registers = {}
+        self.labels = {}
+        # Labels a frame lookup or the caller may still read.
+        self.named = set()
+
+    def label(self, reg):
+        if reg not in self.labels:
+            name = 'r%i' % reg.index
+            self.labels[reg] = name
+            self.registers[name] = reg
+        return self.labels[reg]
+
+    def register(self, label):
+        if label not in self.registers:
+            self.registers[label] = self.defn.newreg()
+        return self.registers[label]
+
+def pipeline(*passes):
+    def optimize(defn):
+        function = lower(defn)
+        for run in passes:
+            run(function)
+        assemble(function)
+    optimize.__name__ = 'pipeline(%s)' % ','.join(run.__name__ for run in passes)
+    return optimize
+
+def lower(defn):
+    function = Function(defn)
+    temps = set(temporaries(defn))
+    function.named.update(function.label(reg)
+        for reg in defn.registers if reg not in temps)
+    blocks = [Block('b%i' % block.index) for block in defn.blocks]
+    function.entry = blocks[0]
+    for block, dst in zip(defn.blocks, blocks):
+        builder = Builder(dst)
+        for instr, location in zip(block.instructions, block.sourcemap):
+            if lower_instruction(function, builder, blocks, instr, location):
+                break
+        if dst.term is None:
+            builder.ret(None)
+    return function
+
+def read(function, builder, arg, location):
+    if isinstance(arg, VirtualRegister):
+        return unbound(function.label(arg))
+    if isinstance(arg, CellRegister):
+        instr = builder.emit('loadcell', [arg], None)
+        instr.location = location
+        return instr
+    return arg
+
+def write(function, builder, dst, instr, location):
+    if isinstance(dst, VirtualRegister):
+        instr.label = function.label(dst)
+    elif isinstance(dst, CellRegister):
+        builder.emit('storecell', [dst, instr], None).location = location
+
+# Returns True once the block is terminated.
+def lower_instruction(function, builder, blocks, instr, location):
+    name = instr[0]
+    builder.dst.location = location
+    if name == 'branch':
+        builder.branch(blocks[instr[1]])
+        return True
+    if name == 'cbranch':
+        cond = read(function, builder, instr[1], location)
+        builder.cbranch(cond, blocks[instr[2]], blocks[instr[3]])
+        return True
+    if name == 'return':
+        builder.ret(read(function, builder, instr[1], location))
+        return True
+    if name == 'closure':
+        res = builder.emit('closure', list(instr[2:]), None)
+    elif name == 'move':
+        value = read(function, builder, instr[2], location)
+        if isinstance(value, Instruction) and value.name == 'unbound':
+            res = builder.emit('move', [value], None)
+        elif isinstance(value, Instruction):
+            res = value
+        else:
+            res = builder.emit('const', [value], None)
+    else:
+        start = 1 if name == 'setattr' else 2
+        args = [read(function, builder, arg, location) for arg in instr[start:]]
+        res = builder.emit(name, args, None)
+    res.location = location
+    if name != 'setattr':
+        write(function, builder, instr[1], res, location)
+    return False
+
+# Blocks reached from the entry, in reverse postorder.
+def layout(entry):
+    order = []
+    seen = set([entry])
+    stack = [(entry, iter(entry.successors))]
+    while len(stack) > 0:
+        block, succ = stack[-1]
+        for target in succ:
+            if target not in seen:
+                seen.add(target)
+                stack.append((target, iter(target.successors)))
+                break
+        else:
+            stack.pop()
+            order.append(block)
+    order.reverse()
+    return order
+
+def arguments(block):
+    for instr in block.instr:
+        for arg in instr.args:
+            yield instr, arg
+    if len(block.term) > 1:
+        yield None, block.term[1]
+
+def assemble(function):
+    defn = function.defn
+    order = layout(function.entry)
+    index = dict((block, i) for i, block in enumerate(order))
+    uses = {}
+    for block in order:
+        for instr, arg in arguments(block):
+            if isinstance(arg, Instruction):
+                uses[arg] = uses.get(arg, 0) + 1
+    results = {}
+    def result(instr):
+        if instr.label is not None:
+            return function.register(instr.label)
+        if instr not in results:
+            results[instr] = defn.newreg()
+        return results[instr]
+    def operand(arg, inline):
+        if not isinstance(arg, Instruction):
+            return arg
+        if arg.name == 'unbound':
+            return function.register(arg.label)
+        if arg in inline:
+            return inline[arg]
+        if arg.name == 'const' and arg.label is None:
+            return arg.args[0]
+        return result(arg)
+    defn.blocks = []
+    for block in order:
+        dst = defn.newblock()
+        # Cell loads used once by a following instruction are folded into
+        # its operands, as long as nothing in between may store to a cell.
+        pending = []
+        def flush(args):
+            inline = {}
+            for load in pending:
+                if load in args:
+                    inline[load] = load.args[0]
+                else:
+                    dst.append(('move', result(load), load.args[0]), load.location)
+            del pending[:]
+            return inline
+        # A value stored to a cell right away is written there directly.
+        stored = {}
+        for prev, instr in zip(block.instr, block.instr[1:]):
+            if (instr.name == 'storecell' and instr.args[1] is prev
+                    and prev.label is None and uses[prev] == 1):
+                stored[prev] = instr.args[0]
+        for instr in block.instr:
+            if instr.name == 'storecell' and instr.args[1] in stored:
+                continue
+            if instr.label is None and instr not in stored:
+                if instr.name == 'const':
+                    continue
+                if instr.name == 'loadcell' and uses.get(instr, 0) <= 1:
+                    if uses.get(instr, 0) == 1:
+                        pending.append(instr)
+                    continue
+            inline = flush(instr.args)
+            args = [operand(arg, inline) for arg in instr.args]
+            if instr in stored:
+                res = stored[instr]
+            elif uses.get(instr, 0) > 0 or instr.label is not None:
+                res = result(instr)
+            else:
+                res = None
+            if instr.name in ('const', 'move', 'loadcell'):
+                dst.append(('move', res) + tuple(args), instr.location)
+            elif instr.name == 'storecell':
+                dst.append(('move',) + tuple(args), instr.location)
+            elif instr.name == 'setattr':
+                dst.append(('setattr',) + tuple(args), instr.location)
+            else:
+                dst.append((instr.name, res) + tuple(args), instr.location)
+        term = block.term
+        inline = flush(term[1:2])
+        if term[0] == 'branch':
+            dst.append(('branch', index[term[2]]), block.location)
+        elif term[0] == 'cbranch':
+            cond = operand(term[1], inline)
+            dst.append(('cbranch', cond, index[term[2]], index[term[3]]), block.location)
+        else:
+            dst.append(('return', operand(term[1], inline)), block.location)
+
+# Drops instructions without effects whose results nobody reads.
+pure = ('const', 'move', 'loadcell', 'closure')
+
+def deadcode(function):
+    flow = analysis.flow(function.entry)
+    live = analysis.liveness(flow).live
+    uses = {}
+    for block in flow.blocks:
+        for instr, arg in arguments(block):
+            if isinstance(arg, Instruction):
+                uses[arg] = uses.get(arg, 0) + 1
+    for block in flow.blocks:
+        alive = live[block] | function.named
+        if analysis.is_unbound(block.term[1]):
+            alive.add(block.term[1].label)
+        for i in reversed(range(len(block.instr))):
+            instr = block.instr[i]
+            if (instr.name in pure and uses.get(instr, 0) == 0
+                    and instr.label not in alive):
+                del block.instr[i]
+                for arg in instr.args:
+                    if isinstance(arg, Instruction):
+                        uses[arg] -= 1
+                continue
+            alive.discard(instr.label)
+            alive.update(arg.label for arg in instr.args if analysis.is_unbound(arg))
+
+# Hoists loop invariant computations into a block run before the loop.
+# Loops are found from back edges: a latch has its header in its
+# dominance frontier, and the header dominates it. Uniform natives are
+# treated as pure, as binding does, and so are attributes of uniform
+# constants. An attribute may move out of any block of the loop. A call
+# moves only from blocks that run on every pass through the loop, as it
+# may fail on arguments that a guard in the loop would have kept from
+# it. Inner loops are done first, and what they hoist may then leave
+# the outer loop.
+def hoist(function):
+    done = set()
+    while True:
+        flow = analysis.flow(function.entry)
+        if len(flow.prec[function.entry]) > 0:
+            entry = Block('entry')
+            entry.term = ('branch', None, function.entry)
+            function.entry = entry
+            continue
+        dominance = analysis.dominance(flow)
+        frontiers = analysis.frontiers(flow, dominance)
+        bodies = {}
+        for latch in flow.blocks:
+            for header in frontiers[latch]:
+                if (header not in done and header in flow.succ[latch]
+                        and analysis.dominates(dominance, header, latch)):
+                    loop(flow, bodies.setdefault(header, set([header])), latch)
+        if len(bodies) == 0:
+            return
+        header = min(bodies, key=lambda header: len(bodies[header]))
+        done.add(header)
+        motion(function, flow, dominance, header, bodies[header])
+
+# Adds the blocks that reach the latch without going through the header.
+def loop(flow, body, latch):
+    stack = [latch]
+    while len(stack) > 0:
+        block = stack.pop()
+        if block not in body:
+            body.add(block)
+            stack.extend(flow.prec[block])
+
+def uniform(obj):
+    return not isinstance(obj, Instruction) and getattr(obj, 'vm_uniform', False)
+
+def motion(function, flow, dominance, header, body):
+    inside = set(instr for block in body for instr in block.instr)
+    written = set(instr.label for instr in inside)
+    # A block that dominates every exit and latch runs on every pass.
+    exits = [block for block in body
+             if any(target not in body for target in flow.succ[block])]
+    exits.extend(prec for prec in flow.prec[header] if prec in body)
+    moved = {}
+    constant = set()
+    def invariant(arg):
+        if analysis.is_unbound(arg):
+            return arg.label not in written
+        return arg not in inside or arg in moved
+    def known(arg):
+        return not isinstance(arg, Instruction) or arg in constant
+    preheader = Block('%s.pre' % header.label)
+    preheader.location = header.location
+    for block in layout(function.entry):
+        if block not in body:
+            continue
+        everytime = all(analysis.dominates(dominance, block, end) for end in exits)
+        for instr in list(block.instr):
+            if instr.name not in ('getattr', 'call') or not uniform(instr.args[0]):
+                continue
+            fixed = all(known(arg) for arg in instr.args)
+            if instr.name == 'getattr' and not fixed:
+                continue
+            if instr.name == 'call' and not (
+                    all(invariant(arg) for arg in instr.args) and everytime):
+                continue
+            args = [moved.get(arg, arg) for arg in instr.args]
+            if instr.label is None:
+                block.instr.remove(instr)
+                copy = instr
+                copy.args = args
+            else:
+                # The variable is still written in the loop, from the copy.
+                copy = Instruction(instr.name, args, None)
+                copy.location = instr.location
+                instr.name = 'move'
+                instr.args = [copy]
+            preheader.instr.append(copy)
+            moved[instr] = copy
+            if fixed:
+                constant.add(instr)
+                constant.add(copy)
+    if len(preheader.instr) == 0:
+        return
+    preheader.term = ('branch', None, header)
+    for prec in flow.prec[header]:
+        if prec not in body:
+            prec.term = prec.term[:2] + tuple(
+                preheader if target is header else target for target in prec.term[2:])
@@ -85,39 +85,67 @@ class Dominance(object):
         self.idom = idom
         self.domi = domi
 
+# Blocks reached from the entry, each after all of its successors.
+def postorder(flow):
+    order = []
+    seen = set([flow.entry])
+    stack = [(flow.entry, iter(flow.succ[flow.entry]))]
+    while len(stack) > 0:
+        block, succ = stack[-1]
+        for target in succ:
+            if target not in seen:
+                seen.add(target)
+                stack.append((target, iter(flow.succ[target])))
+                break
+        else:
+            stack.pop()
+            order.append(block)
+    return order
+
+# Iterates immediate dominators to a fixed point in reverse postorder,
+# as in Cooper, Harvey and Kennedy's "A Simple, Fast Dominance Algorithm".
 def dominance(flow):
-    idom = {flow.entry:None}
-    layer = {flow.entry:0}
+    order = postorder(flow)
+    number = dict((block, i) for i, block in enumerate(order))
+    idom = {flow.entry:flow.entry}
+    def intersect(a, b):
+        while a is not b:
+            while number[a] < number[b]:
+                a = idom[a]
+            while number[b] < number[a]:
+                b = idom[b]
+        return a
+    changing = True
+    while changing:
+        changing = False
+        for block in reversed(order):
+            if block is flow.entry:
+                continue
+            dominator = None
+            for prec in flow.prec[block]:
+                if prec not in idom:
+                    continue
+                if dominator is None:
+                    dominator = prec
+                else:
+                    dominator = intersect(prec, dominator)
+            if idom.get(block) is not dominator:
+                idom[block] = dominator
+                changing = True
+    idom[flow.entry] = None
     domi = {}
-    breath = [flow.entry]
-    while len(breath) > 0:
-        block = breath.pop(0)
-        for successor in flow.succ[block]:
-            if successor in idom:
-                a, b = block, successor
-                layer_a = layer[a]
-                layer_b = layer[b]
-                floor = min(layer_a, layer_b)
-                for _ in range(floor, layer_a):
-                    a = idom[a]
-                for _ in range(floor, layer_b):
-                    b = idom[b]
-                while a is not b:
-                    a = idom[a]
-                    b = idom[b]
-                dominator = a
-            else:
-                dominator = block
-                breath.append(successor)
-            if successor is not dominator:
-                idom[successor] = dominator
-                layer[successor] = layer[dominator] + 1
-                print 'idom[%r] = %r (l%i)' % (successor, dominator, layer[dominator] + 1)
     for dst, src in idom.items():
         if src is not None:
             push(domi, src, dst)
     return Dominance(idom, domi)
 
+def dominates(dominance, a, b):
+    while b is not None:
+        if a is b:
+            return True
+        b = dominance.idom[b]
+    return False
+
 def frontiers(flow, dominance):
     frontiers = dict((block,[]) for block in flow.blocks)
     for block in flow.blocks:
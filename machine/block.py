@@ -3,6 +3,7 @@ class Block(object):
         self.label = label
         self.instr = []
         self.term = None
+        self.location = None # of the terminator
         self.phi = {} # label:block:arg where (block in prec[self])
 
     @property
@@ -20,6 +21,7 @@ class Instruction(object):
         self.name = name
         self.args = args
         self.label = label
+        self.location = None
 
     def __repr__(self):
         if self.label is not None:
@@ -1,33 +1,53 @@
+from lisp import read
+
 class Scope(object):
     def __init__(self, parent=None):
         self.parent = parent
         self.objects = {}
 
     def lookup(self, name):
-        if name in self:
-            return self[name]
-        elif self.parent is not None:
-            return self.parent.lookup(name)
+        scope = self
+        while scope is not None:
+            objects = scope.objects
+            if name in objects:
+                return objects[name]
+            scope = scope.parent
 
     def __contains__(self, name):
         return name in self.objects
     def __getitem__(self, name):
         return self.objects[name]
     def __setitem__(self, name, value):
-        self.objects[name] = value
+        self.objects[read.symbol(name)] = value
 
 class Defn(object):
-    def __init__(self, scope):
+    def __init__(self, scope, parent=None):
         self.argc = 0
         self.registers = []
         self.blocks = []
         self.scope = scope
+        self.parent = parent
+        self.params = []
+        self.cellvars = []
+        self.freevars = []
+        self.cells = {}
+        self.code = None
+        self.function = None
+        # Set while the body waits to be built, see defer.
+        self.stub = None
+        # How the constants made at build time were made, by id.
+        self.recipes = {}
 
     def newreg(self):
         reg = VirtualRegister(self, len(self.registers))
         self.registers.append(reg)
         return reg
 
+    def newarg(self):
+        reg = self.newreg()
+        self.params.append(reg)
+        return reg
+
     def newblock(self):
         reg = Block(self, len(self.blocks))
         self.blocks.append(reg)
@@ -40,6 +60,20 @@ class VirtualRegister(object):
     def __repr__(self):
         return 'r%i' % self.index
 
+# A variable shared between a defn and the closures nested in it. The
+# frame holds the cells of its own captured registers first, then the
+# cells its closure captured from enclosing frames.
+class CellRegister(object):
+    def __init__(self, defn, index):
+        self.defn = defn
+        self.index = index
+    def __repr__(self):
+        return 'c%i' % self.index
+
+class Cell(object):
+    def __init__(self, value=None):
+        self.value = value
+
 class Block(object):
     def __init__(self, defn, index):
         self.defn = defn
@@ -61,54 +95,25 @@ class Block(object):
         return ( '%3i:    ' % self.index
                + '\n        '.join(repr(i) for i in self.instructions) )
 
+# Instructions that store a result into their first operand, and the
+# ones that end a block. Whatever follows a terminator is never run.
+writers = ('call', 'getattr', 'callattr', 'move', 'closure')
+terminators = ('return', 'branch', 'cbranch')
+
+def successors(block):
+    for instr in block:
+        if instr[0] == 'branch':
+            return [instr[1]]
+        if instr[0] == 'cbranch':
+            return [instr[2], instr[3]]
+        if instr[0] == 'return':
+            return []
+    return []
+
 class Closure(object):
-    def __init__(self, frame, defn):
-        self.frame = frame
+    def __init__(self, defn, cells=()):
         self.defn  = defn
-
-class Frame(object):
-    def __init__(self, ret, closure):
-        self.ret = ret
-        self.closure = closure
-        self.defn = closure.defn
-        self.entryvar = None
-        self.registers = [None for _ in closure.defn.registers]
-        self.block = closure.defn.blocks[0]
-        self.pc = 0
-
-    def pass_arguments(self, argv):
-        if self.defn.argc < len(argv):
-            return False
-        for i in range(self.defn.argc):
-            self.registers[i] = argv[i]
-        return True
-
-    def fetch(self, arg):
-        if isinstance(arg, VirtualRegister):
-            if self.defn is arg.defn:
-                return self.registers[arg.index]
-            else:
-                return self.closure.frame.fetch(arg)
-        else:
-            return arg
-
-    def store(self, arg, value):
-        if arg is None:
-            return
-        assert isinstance(arg, VirtualRegister)
-        if self.defn is arg.defn:
-            self.registers[arg.index] = value
-        else:
-            self.closure.frame.store(arg, value)
-
-    def resume(self, value):
-        self.store(self.entryvar, value)
-        return self
-
-    def lookup(self, name):
-        arg = self.defn.scope.lookup(name)
-        if arg is not None:
-            return self.fetch(arg)
+        self.cells = cells
 
 class Builder(object):
     def __init__(self, defn, macros):
@@ -117,6 +122,8 @@ class Builder(object):
         self.flag   = None
         self.block  = defn.newblock()
         self.location = None
+        # The defn passes for deferred defns, or None to build them now.
+        self.lazy   = None
 
     def emit(self, *args):
         self.block.append(args, self.location)
@@ -210,18 +217,170 @@ def build_stmt(builder, expr):
         return build_call(builder, expr, None)
     raise Exception('nonsensical %s' % expr.name)
 
-def build_defn(args, body, scope, macros):
-    defn = Defn(Scope(scope))
+def build_defn(args, body, scope, macros, parent=None, lazy=None):
+    defn = Defn(Scope(scope), parent)
+    fill(defn, args, body, macros, lazy)
+    return defn
+
+# Errors are given the location of the expression being built, unless
+# they already have one.
+def fill(defn, args, body, macros, lazy, freevars=None):
     builder = Builder(defn, macros)
+    builder.lazy = lazy
     for arg in args:
         defn.scope[arg] = defn.newarg()
     defn.argc = len(args)
-    for stmt in body:
-        build_stmt(builder, stmt)
+    try:
+        for stmt in body:
+            build_stmt(builder, stmt)
+    except Exception as error:
+        if getattr(error, 'location', None) is None:
+            error.location = builder.location
+        raise
+    resolve_cells(defn, freevars)
+
+# Program passes take the root closure once every defn is built. After
+# them the defn passes run on every defn, the nested ones first.
+# A lazy build leaves the nested defns as stubs, which are built and
+# go through the defn passes on their first call. Program passes need
+# every defn, so they do not run.
+def build(body, scope, macros, passes=(), program=(), lazy=False):
+    closure = Closure(build_defn([], body, scope, macros,
+                                 lazy=list(passes) if lazy else None))
+    if lazy:
+        program = ()
+    for optimize in program:
+        optimize(closure)
+    for defn in postorder(closure.defn):
+        if defn.stub is None:
+            for optimize in passes:
+                optimize(defn)
+    return closure
+
+class Stub(object):
+    def __init__(self, args, expr, start, macros, passes, freevars):
+        self.args = args
+        self.expr = expr
+        self.start = start
+        self.macros = macros
+        self.passes = passes
+        self.freevars = freevars
+
+# A deferred defn resolves its names when it is built, so the ones its
+# body may use are looked up now and kept in a scope of their own. Any
+# of them that is a register of an enclosing defn is taken as captured,
+# since the parent has to make the cells before the body is built.
+def defer(builder, args, expr, start):
+    parent = builder.defn
+    names = Scope()
+    freevars = []
+    for name in body_names(expr, start):
+        obj = parent.scope.lookup(name)
+        if obj is None or name in names:
+            continue
+        names.objects[name] = obj
+        if isinstance(obj, VirtualRegister) and obj not in freevars:
+            freevars.append(obj)
+    defn = Defn(Scope(names), parent)
+    defn.freevars = freevars
+    defn.stub = Stub(args, expr, start, builder.macros, builder.lazy, freevars)
     return defn
 
-def build(body, scope, macros):
-    return Closure(None, build_defn([], body, scope, macros))
+# Builds a deferred defn and runs the defn passes over it. If that
+# fails, the stub stays so that the next call fails the same way.
+def realize(defn):
+    stub = defn.stub
+    try:
+        fill(defn, stub.args, stub.expr[stub.start:], stub.macros, stub.passes, stub.freevars)
+    except:
+        defn.registers = []
+        defn.blocks = []
+        defn.params = []
+        defn.scope.objects.clear()
+        raise
+    defn.stub = None
+    for optimize in stub.passes:
+        optimize(defn)
+
+# Symbols in the body of a (def ...) or (lambda ...). A body the lazy
+# reader has not read yet is scanned for symbol tokens instead.
+def body_names(expr, start):
+    if isinstance(expr.value, read.Lazy) and expr.value.items is None:
+        return source_names(expr.value)
+    return node_names(expr.value[start:])
+
+def node_names(nodes):
+    stack = list(reversed(nodes))
+    while len(stack) > 0:
+        node = stack.pop()
+        if node.name == 'symbol':
+            yield node.value
+        elif node.name == 'list' and isinstance(node.value, read.Lazy) and node.value.items is None:
+            for name in node_names(node.value.head):
+                yield name
+            for name in source_names(node.value):
+                yield name
+        elif node.name == 'list':
+            stack.extend(reversed(node.value))
+        elif node.name == 'attribute' and node.value[1] is not None:
+            stack.append(node.value[1])
+
+def source_names(lazy):
+    unicode_source = type(lazy.source) is unicode
+    sym = read.symbol if unicode_source else intern
+    for m in read.tokens[unicode_source].finditer(lazy.source, lazy.start, lazy.stop):
+        if m.lastindex == 7:
+            yield sym(m.group())
+
+def postorder(defn):
+    for block in defn.blocks:
+        for instr in block:
+            if instr[0] == 'closure':
+                for nested in postorder(instr[2]):
+                    yield nested
+    yield defn
+
+# Turns every register shared across defns into a cell. The nested defns
+# are complete by now, so their freevars tell which of our registers they
+# capture. Registers of enclosing defns become our own freevars, and each
+# closure instruction lists the cells it takes from the frame.
+def resolve_cells(defn, promised=None):
+    cellvars = []
+    freevars = []
+    seen = set()
+    for block in defn.blocks:
+        for instr in block:
+            regs = [arg for arg in instr[1:] if isinstance(arg, VirtualRegister)]
+            if instr[0] == 'closure':
+                regs.extend(instr[2].freevars)
+            for reg in regs:
+                if reg in seen:
+                    continue
+                if reg.defn is not defn:
+                    seen.add(reg)
+                    freevars.append(reg)
+                elif instr[0] == 'closure' and reg in instr[2].freevars:
+                    seen.add(reg)
+                    cellvars.append(reg)
+    # A deferred defn keeps the freevars its closures were made with.
+    if promised is not None:
+        assert all(reg in promised for reg in freevars)
+        freevars = promised
+    defn.cellvars = cellvars
+    defn.freevars = freevars
+    cells = defn.cells
+    for reg in cellvars + freevars:
+        cells[reg] = CellRegister(defn, len(cells))
+    if len(cells) == 0:
+        return
+    for block in defn.blocks:
+        for i, instr in enumerate(block):
+            instr = tuple(cells.get(arg, arg) if isinstance(arg, VirtualRegister) else arg
+                          for arg in instr)
+            if instr[0] == 'closure':
+                instr += tuple(cells[reg] for reg in instr[2].freevars)
+            block[i] = instr
+    defn.params = [cells.get(reg, reg) for reg in defn.params]
 
 def toint(expr):
     assert expr.name == 'number'
@@ -244,14 +403,17 @@ def m_def(builder, expr):
     name = tosymbol(expr[1])
     args = [tosymbol(arg) for arg in tolist(expr[2])]
     res = builder.defn.scope[name] = builder.defn.newreg()
-    defn = build_defn(args, expr[3:], builder.defn.scope, builder.macros)
-    return builder.emit_closure(res, defn)
+    return builder.emit_closure(res, nested(builder, args, expr, 3))
 
 def m_lambda(builder, expr):
     args = [tosymbol(arg) for arg in tolist(expr[1])]
     res = builder.defn.newreg()
-    defn = build_defn(args, expr[2:], builder.defn.scope, builder.macros)
-    return builder.emit_closure(res, defn)
+    return builder.emit_closure(res, nested(builder, args, expr, 2))
+
+def nested(builder, args, expr, start):
+    if builder.lazy is not None:
+        return defer(builder, args, expr, start)
+    return build_defn(args, expr[start:], builder.defn.scope, builder.macros, builder.defn)
 
 def m_return(builder, expr):
     builder.emit_return(build_expr(builder, expr[1]))
@@ -350,7 +512,7 @@ def m_while(builder, expr):
     builder.emit_branch(condblock)
     builder.block = contblock
 
-macros = {
+macros = dict((read.symbol(name), macro) for name, macro in {
     'def': m_def,
     'lambda': m_lambda,
     'return': m_return,
@@ -362,4 +524,4 @@ macros = {
     'else': m_else,
     'while': m_while,
     #'for': m_for,
-}
+}.items())
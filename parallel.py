@@ -0,0 +1,131 @@
+import marshal, multiprocessing
+from machinecode import Scope, Defn, VirtualRegister, Closure, build_defn, postorder
+import codecache
+
+# Runs the defn passes of the top-level defns in a process pool. The
+# program is built and goes through the program passes in the parent,
+# as those need every defn. After them a defn pass looks at nothing but
+# the defn it runs on, so each defn made by the root, together with its
+# nested defns, can be done elsewhere and comes back the same as from a
+# serial build. The trees travel in the codecache layout. Constants go
+# by their index in a table kept by the parent, and the workers see
+# stand-ins that only tell whether the constant is uniform. Registers
+# of the root are numbered the same on both sides, so the freevars of
+# a tree that comes back are the root's own.
+
+class Constant(object):
+    def __init__(self, uniform):
+        self.vm_uniform = uniform
+
+# Stands in for the root in a worker. Only the registers the tree
+# captures are made.
+class Registers(dict):
+    def __init__(self, defn):
+        self.defn = defn
+
+    def __missing__(self, index):
+        reg = self[index] = VirtualRegister(self.defn, index)
+        return reg
+
+class Writer(codecache.Writer):
+    def __init__(self, defn, objects):
+        codecache.Writer.__init__(self, defn, None)
+        self.objects = objects
+        self.slots = dict((id(obj), i) for i, obj in enumerate(objects))
+
+    def value(self, obj):
+        if isinstance(obj, codecache.plain):
+            return ('k', obj)
+        if id(obj) not in self.slots:
+            self.slots[id(obj)] = len(self.objects)
+            self.objects.append(obj)
+        return ('o', self.slots[id(obj)])
+
+def dump(defn, objects):
+    writer = Writer(defn, objects)
+    defns = [writer.defn(nested) for nested in writer.defns]
+    return marshal.dumps((writer.paths, defns))
+
+def load(data, objects, parent):
+    paths, entries = marshal.loads(data)
+    def value(tag, arg):
+        if tag == 'k':
+            return arg
+        return objects[arg]
+    return codecache.unpack(entries, paths, value, parent.scope, parent)[0]
+
+# The passes reach the workers when the pool starts, as they are often
+# closures that do not pickle.
+passes = ()
+
+def setup(defn_passes):
+    global passes
+    passes = defn_passes
+
+def start(defn_passes, processes=None):
+    return multiprocessing.Pool(processes, setup, (list(defn_passes),))
+
+def optimize(task):
+    return refine(task, passes)
+
+# Runs the passes over a tree made into a task by split().
+def refine((uniform, data), passes):
+    root = Defn(Scope())
+    root.registers = Registers(root)
+    objects = [Constant(flag) for flag in uniform]
+    defn = load(data, objects, root)
+    for nested in postorder(defn):
+        for run in passes:
+            run(nested)
+    return dump(defn, objects)
+
+# Closure instructions of the root whose trees can be done elsewhere:
+# every defn in them is built, and no other instruction makes them.
+def independent(root):
+    count = {}
+    for block in root.blocks:
+        for instr in block:
+            if instr[0] == 'closure':
+                count[instr[2]] = count.get(instr[2], 0) + 1
+    for block in root.blocks:
+        for index, instr in enumerate(block):
+            if instr[0] != 'closure' or count[instr[2]] > 1:
+                continue
+            if all(defn.stub is None for defn in postorder(instr[2])):
+                yield block, index
+
+# A task for each independent tree, with the constants it refers to.
+def split(root):
+    jobs = list(independent(root))
+    tasks = []
+    tables = []
+    for block, index in jobs:
+        objects = []
+        data = dump(block[index][2], objects)
+        uniform = [bool(getattr(obj, 'vm_uniform', False)) for obj in objects]
+        tasks.append((uniform, data))
+        tables.append(objects)
+    return jobs, tasks, tables
+
+# Puts the trees that came back in place of the ones sent, and runs the
+# passes over the rest.
+def join(root, jobs, tables, results, passes):
+    done = set()
+    for (block, index), objects, data in zip(jobs, tables, results):
+        instr = block[index]
+        defn = load(data, objects, root)
+        block[index] = instr[:2] + (defn,) + instr[3:]
+        done.update(postorder(defn))
+    for defn in postorder(root):
+        if defn not in done:
+            for run in passes:
+                run(defn)
+
+# The pool comes from start(), with the same passes.
+def build(body, scope, macros, pool, passes=(), program=()):
+    closure = Closure(build_defn([], body, scope, macros))
+    for run in program:
+        run(closure)
+    jobs, tasks, tables = split(closure.defn)
+    join(closure.defn, jobs, tables, pool.map(optimize, tasks), passes)
+    return closure
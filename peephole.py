@@ -0,0 +1,238 @@
+from machinecode import VirtualRegister, CellRegister, successors, writers, terminators
+from regalloc import local, effects, liveness, temporaries
+
+# Cleans up after the macros: copies are propagated within blocks, moves
+# into dead temporaries are dropped, branches to trivial blocks are
+# threaded and straight-line chains of blocks are merged into one. The
+# VM has no fallthrough, a block that runs off its end returns, so the
+# merging is what turns the common branches into straight-line code.
+
+def optimize(defn):
+    truncate(defn)
+    simplify(defn)
+    propagate(defn)
+    eliminate(defn)
+    simplify(defn)
+
+def delete(block, index):
+    del block.instructions[index]
+    del block.sourcemap[index]
+
+# Whatever follows the first terminator is never run.
+def truncate(defn):
+    for block in defn.blocks:
+        for i, instr in enumerate(block):
+            if instr[0] in terminators:
+                del block.instructions[i+1:]
+                del block.sourcemap[i+1:]
+                break
+
+def terminator(block):
+    if len(block) > 0 and block[-1][0] in terminators:
+        return block[-1]
+
+def propagate(defn):
+    for block in defn.blocks:
+        copies = {}
+        i = 0
+        while i < len(block):
+            instr = block[i]
+            start = 2 if instr[0] in writers else 1
+            instr = instr[:start] + tuple(
+                copies.get(arg, arg) if local(defn, arg) else arg
+                for arg in instr[start:])
+            block[i] = instr
+            dst, args = effects(defn, instr)
+            if dst is not None:
+                for reg, value in copies.items():
+                    if reg is dst or value is dst:
+                        del copies[reg]
+            if instr[0] == 'move' and dst is not None:
+                value = instr[2]
+                if value is dst:
+                    delete(block, i)
+                    continue
+                # Cells may change under a call, so only plain values
+                # and our own registers are copied.
+                if local(defn, value) or not isregister(value):
+                    copies[dst] = value
+            i += 1
+
+def isregister(arg):
+    return isinstance(arg, (VirtualRegister, CellRegister))
+
+# Moves and closures have no effects, they can go when nothing reads
+# the temporary they write.
+def eliminate(defn):
+    temps = set(temporaries(defn))
+    if len(temps) == 0:
+        return
+    livein, liveout = liveness(defn)
+    for block, out in zip(defn.blocks, liveout):
+        live = set(out)
+        for i in reversed(range(len(block))):
+            instr = block[i]
+            dst, args = effects(defn, instr)
+            if instr[0] in ('move', 'closure') and dst in temps and dst not in live:
+                delete(block, i)
+                continue
+            live.discard(dst)
+            live.update(args)
+
+def simplify(defn):
+    changed = True
+    while changed:
+        changed = fold(defn)
+        changed |= thread(defn)
+        changed |= merge(defn)
+    renumber(defn)
+
+# Branches on constants, or to the same block either way.
+def fold(defn):
+    changed = False
+    for block in defn.blocks:
+        instr = terminator(block)
+        if instr is None or instr[0] != 'cbranch':
+            continue
+        if instr[2] == instr[3]:
+            block[-1] = ('branch', instr[2])
+        elif not isregister(instr[1]):
+            block[-1] = ('branch', instr[2] if instr[1] else instr[3])
+        else:
+            continue
+        changed = True
+    return changed
+
+# Follows branches through blocks that do nothing but branch. A branch
+# into an empty block returns right away. When the flag a block tests is
+# already known on the way in, as it is along the if/elif/else chains,
+# the test is skipped.
+def thread(defn):
+    blocks = defn.blocks
+    preds = predecessors(defn)
+    def follow(index):
+        seen = set()
+        while index not in seen:
+            seen.add(index)
+            target = blocks[index]
+            if len(target) != 1 or target[0][0] != 'branch':
+                return index
+            index = target[0][1]
+        return index
+    # Where a branch ends up when the flag tested along the way is known.
+    def retest(flag, index, taken):
+        seen = set()
+        while index not in seen:
+            seen.add(index)
+            target = blocks[index]
+            if len(target) != 1 or target[0][0] != 'cbranch' or target[0][1] is not flag:
+                return index
+            index = follow(target[0][3 - taken])
+        return index
+    # The value of a flag at the end of a block entered only through a
+    # cbranch on it, 1 or 0, or None when it is not known.
+    def known(block, flag):
+        if not local(defn, flag) or len(preds[block.index]) != 1:
+            return None
+        test = terminator(blocks[preds[block.index][0]])
+        if test[0] != 'cbranch' or test[1] is not flag or test[2] == test[3]:
+            return None
+        for instr in block:
+            if effects(defn, instr)[0] is flag:
+                return None
+        return int(test[2] == block.index)
+    changed = False
+    for block in [blocks[index] for index in live_blocks(defn)]:
+        instr = terminator(block)
+        if instr is None:
+            continue
+        if instr[0] == 'branch':
+            index = follow(instr[1])
+            target = blocks[index]
+            if len(target) == 1 and target[0][0] == 'cbranch':
+                taken = known(block, target[0][1])
+                if taken is not None:
+                    index = retest(target[0][1], index, taken)
+            if len(blocks[index]) == 0:
+                new = ('return', None)
+            else:
+                new = ('branch', index)
+        elif instr[0] == 'cbranch':
+            flag = instr[1]
+            yes = retest(flag, follow(instr[2]), 1)
+            no = retest(flag, follow(instr[3]), 0)
+            new = ('cbranch', flag, yes, no)
+        else:
+            continue
+        if new != instr:
+            for succ in successors(block):
+                preds[succ].remove(block.index)
+            block[-1] = new
+            for succ in successors(block):
+                preds[succ].append(block.index)
+            changed = True
+    return changed
+
+# A block that is branched to from only one place is appended there.
+def merge(defn):
+    blocks = defn.blocks
+    preds = predecessors(defn)
+    changed = False
+    for block in blocks:
+        instr = terminator(block)
+        while instr is not None and instr[0] == 'branch':
+            index = instr[1]
+            if index == 0 or preds[index] != [block.index]:
+                break
+            target = blocks[index]
+            block.instructions[-1:] = target.instructions
+            block.sourcemap[-1:] = target.sourcemap
+            target.instructions = []
+            target.sourcemap = []
+            preds[index] = []
+            for succ in successors(block):
+                preds[succ] = [block.index if p == index else p for p in preds[succ]]
+            instr = terminator(block)
+            changed = True
+    return changed
+
+def predecessors(defn):
+    preds = [[] for _ in defn.blocks]
+    for index in live_blocks(defn):
+        for succ in successors(defn.blocks[index]):
+            preds[succ].append(index)
+    return preds
+
+# Indices of the blocks reached from the entry, in reverse postorder.
+def live_blocks(defn):
+    order = []
+    seen = set([0])
+    stack = [(0, iter(successors(defn.blocks[0])))]
+    while len(stack) > 0:
+        index, succ = stack[-1]
+        for target in succ:
+            if target not in seen:
+                seen.add(target)
+                stack.append((target, iter(successors(defn.blocks[target]))))
+                break
+        else:
+            stack.pop()
+            order.append(index)
+    order.reverse()
+    return order
+
+# Drops the unreachable blocks and lays the rest out in reverse postorder.
+def renumber(defn):
+    order = live_blocks(defn)
+    mapping = dict((old, new) for new, old in enumerate(order))
+    blocks = [defn.blocks[index] for index in order]
+    for block in blocks:
+        block.index = mapping[block.index]
+        instr = terminator(block)
+        if instr is None:
+            continue
+        if instr[0] == 'branch':
+            block[-1] = ('branch', mapping[instr[1]])
+        elif instr[0] == 'cbranch':
+            block[-1] = ('cbranch', instr[1], mapping[instr[2]], mapping[instr[3]])
+    defn.blocks = blocks
@@ -0,0 +1,180 @@
+from machinecode import VirtualRegister, CellRegister, Closure, Cell
+import machinecode
+
+# Translates a defn into a Python function, as an alternative to running
+# it in virtualmachine. Registers become locals r0, r1.., cells become
+# locals c0, c1.. holding Cell objects, and constants that have no literal
+# are free variables k0, k1.. of the function. Every block is an if
+# statement on the block number b inside a loop, so a branch to a later
+# block falls through to it and a branch back goes around the loop.
+# Closures are called as Python functions, everything else goes through
+# vm_call. The function is made on the first call and cached on
+# Defn.function. Lisp calls nest as Python calls, so deep recursion is
+# limited by the recursion limit of Python.
+
+literals = (int, long, bool, str, unicode, type(None))
+
+class Frame(object):
+    def __init__(self, closure):
+        self.closure = closure
+        self.defn = closure.defn
+        self.regs = [None] * len(self.defn.registers)
+        self.cells = []
+
+    def lookup(self, name):
+        arg = self.defn.scope.lookup(name)
+        if isinstance(arg, VirtualRegister):
+            arg = self.defn.cells.get(arg, arg)
+            if arg.defn is not self.defn:
+                return None
+        if isinstance(arg, CellRegister):
+            return self.cells[arg.index].value
+        if isinstance(arg, VirtualRegister):
+            return self.regs[arg.index]
+        return arg
+
+class Source(object):
+    def __init__(self):
+        self.lines = []
+        self.depth = 0
+        self.constants = {}
+        self.names = []
+
+    def line(self, text):
+        self.lines.append('    ' * self.depth + text)
+
+    def constant(self, value):
+        if isinstance(value, literals):
+            return repr(value)
+        key = id(value)
+        if key not in self.constants:
+            self.constants[key] = 'k%i' % len(self.names)
+            self.names.append(value)
+        return self.constants[key]
+
+    def read(self, arg):
+        if isinstance(arg, VirtualRegister):
+            return 'r%i' % arg.index
+        if isinstance(arg, CellRegister):
+            return 'c%i.value' % arg.index
+        return self.constant(arg)
+
+    def write(self, arg):
+        if isinstance(arg, (VirtualRegister, CellRegister)):
+            return self.read(arg)
+        return '_'
+
+def translate(defn, frame=None):
+    if defn.stub is not None:
+        machinecode.realize(defn)
+    source = Source()
+    params = []
+    prologue = []
+    for i, param in enumerate(defn.params):
+        if isinstance(param, CellRegister):
+            params.append('a%i=None' % i)
+            prologue.append('c%i.value = a%i' % (param.index, i))
+        else:
+            params.append('r%i=None' % param.index)
+    source.depth = 1
+    source.line('def defn(%s):' % ', '.join(['cells'] + params))
+    source.depth = 2
+    for index in range(len(defn.cellvars)):
+        source.line('c%i = Cell()' % index)
+    if len(defn.freevars) > 0:
+        ncells = len(defn.cellvars) + len(defn.freevars)
+        free = ['c%i' % index for index in range(len(defn.cellvars), ncells)]
+        source.line('%s, = cells' % ', '.join(free))
+    unset = ['r%i' % reg.index for reg in defn.registers if reg not in defn.params]
+    if len(unset) > 0:
+        source.line("%s = None" % " = ".join(unset))
+    for text in prologue:
+        source.line(text)
+    # The root frame gets the registers and cells back for lookup().
+    if frame is not None:
+        source.line('try:')
+        source.depth += 1
+    if len(defn.blocks) > 1:
+        source.line('b = 0')
+        source.line('while 1:')
+        source.depth += 1
+    for block in defn.blocks:
+        if len(defn.blocks) > 1:
+            source.line('if b == %i:' % block.index)
+            source.depth += 1
+        for instr in block:
+            if emit(source, instr):
+                break
+        else:
+            source.line('return None')
+        if len(defn.blocks) > 1:
+            source.depth -= 1
+    if frame is not None:
+        source.depth = 2
+        source.line('finally:')
+        source.line('    frame.regs = [%s]' % ', '.join(
+            'r%i' % reg.index for reg in defn.registers))
+        ncells = len(defn.cellvars) + len(defn.freevars)
+        source.line('    frame.cells = [%s]' % ', '.join(
+            'c%i' % index for index in range(ncells)))
+    source.depth = 1
+    source.line('return defn')
+    names = ['Closure', 'Cell', 'translate', 'frame'] + [
+        'k%i' % i for i in range(len(source.names))]
+    text = 'def make(%s):\n%s\n' % (', '.join(names), '\n'.join(source.lines))
+    namespace = {}
+    exec compile(text, '<defn>', 'exec') in namespace
+    function = namespace['make'](Closure, Cell, translate, frame, *source.names)
+    function.source = text
+    if frame is None:
+        defn.function = function
+    return function
+
+# Returns True once the block is terminated.
+def emit(source, instr):
+    name = instr[0]
+    if name == 'move':
+        source.line('%s = %s' % (source.write(instr[1]), source.read(instr[2])))
+    elif name == 'call':
+        source.line('f = %s' % source.read(instr[2]))
+        call(source, instr[1], instr[3:])
+    elif name == 'callattr':
+        source.line('f = %s.vm_getattr(%s)' % (source.read(instr[2]), source.read(instr[3])))
+        call(source, instr[1], instr[4:])
+    elif name == 'getattr':
+        source.line('%s = %s.vm_getattr(%s)' % (source.write(instr[1]),
+            source.read(instr[2]), source.read(instr[3])))
+    elif name == 'setattr':
+        source.line('%s.vm_setattr(%s, %s)' % tuple(source.read(arg) for arg in instr[1:]))
+    elif name == 'closure':
+        cells = ''.join('c%i, ' % cell.index for cell in instr[3:])
+        source.line('%s = Closure(%s, [%s])' % (source.write(instr[1]),
+            source.constant(instr[2]), cells))
+    elif name == 'branch':
+        source.line('b = %i' % instr[1])
+        return True
+    elif name == 'cbranch':
+        source.line('if %s:' % source.read(instr[1]))
+        source.line('    b = %i' % instr[2])
+        source.line('else:')
+        source.line('    b = %i' % instr[3])
+        return True
+    elif name == 'return':
+        source.line('return %s' % source.read(instr[1]))
+        return True
+    else:
+        raise Exception("no such instruction %s" % name)
+    return False
+
+def call(source, dst, argv):
+    args = ', '.join(source.read(arg) for arg in argv)
+    dst = source.write(dst)
+    source.line('if f.__class__ is Closure:')
+    source.line('    %s = (f.defn.function or translate(f.defn))(f.cells, %s)' % (dst, args))
+    source.line('else:')
+    source.line('    %s = f.vm_call([%s])' % (dst, args))
+
+def run(closure, argv):
+    frame = Frame(closure)
+    value = translate(closure.defn, frame)(closure.cells, *argv)
+    return frame, value
@@ -0,0 +1,107 @@
+from machinecode import VirtualRegister, successors, writers, terminators
+
+# Temporaries from build_expr each get their own register, although few
+# of them are live at once. This pass packs temporaries whose live ranges
+# do not overlap into shared registers. Arguments and named variables
+# keep registers of their own, so Frame.lookup still finds them.
+
+def local(defn, arg):
+    return isinstance(arg, VirtualRegister) and arg.defn is defn
+
+# The register an instruction writes and the ones it reads.
+def effects(defn, instr):
+    if instr[0] in writers:
+        dst = instr[1] if local(defn, instr[1]) else None
+        args = instr[2:]
+    else:
+        dst = None
+        args = instr[1:]
+    return dst, [arg for arg in args if local(defn, arg)]
+
+# Instructions up to and including the first terminator.
+def reachable(block):
+    for i, instr in enumerate(block):
+        if instr[0] in terminators:
+            return block.instructions[:i+1]
+    return block.instructions
+
+# Registers live on entry to, and on exit from, each block.
+def liveness(defn):
+    uses = []
+    defs = []
+    for block in defn.blocks:
+        use = set()
+        kill = set()
+        for instr in reachable(block):
+            dst, args = effects(defn, instr)
+            use.update(arg for arg in args if arg not in kill)
+            if dst is not None:
+                kill.add(dst)
+        uses.append(use)
+        defs.append(kill)
+    succ = [successors(block) for block in defn.blocks]
+    livein = [set(use) for use in uses]
+    liveout = [set() for _ in defn.blocks]
+    changed = True
+    while changed:
+        changed = False
+        for index in reversed(range(len(defn.blocks))):
+            out = set()
+            for target in succ[index]:
+                out.update(livein[target])
+            if out != liveout[index]:
+                liveout[index] = out
+                live = uses[index] | (out - defs[index])
+                if live != livein[index]:
+                    livein[index] = live
+                changed = True
+    return livein, liveout
+
+def interference(defn, liveout):
+    edges = dict((reg, set()) for reg in defn.registers)
+    for block, out in zip(defn.blocks, liveout):
+        live = set(out)
+        for instr in reversed(reachable(block)):
+            dst, args = effects(defn, instr)
+            if dst is not None:
+                for reg in live:
+                    if reg is not dst:
+                        edges[dst].add(reg)
+                        edges[reg].add(dst)
+                live.discard(dst)
+            live.update(args)
+    return edges
+
+# Registers that are neither arguments nor bound to a name.
+def temporaries(defn):
+    named = set(arg for arg in defn.scope.objects.values() if local(defn, arg))
+    named.update(defn.registers[:defn.argc])
+    named.update(defn.cellvars)
+    return [reg for reg in defn.registers if reg not in named]
+
+def allocate(defn):
+    temps = temporaries(defn)
+    pooled = set(temps)
+    fixed = [reg for reg in defn.registers if reg not in pooled]
+    if len(temps) == 0:
+        return
+    livein, liveout = liveness(defn)
+    edges = interference(defn, liveout)
+    colors = {}
+    shared = []
+    for reg in temps:
+        taken = set(colors[other] for other in edges[reg] if other in colors)
+        color = 0
+        while color in taken:
+            color += 1
+        colors[reg] = color
+        if color == len(shared):
+            shared.append(VirtualRegister(defn, len(fixed) + color))
+    for index, reg in enumerate(fixed):
+        reg.index = index
+    rename = dict((reg, shared[color]) for reg, color in colors.items())
+    for block in defn.blocks:
+        for i, instr in enumerate(block):
+            block[i] = tuple(rename.get(arg, arg) if local(defn, arg) else arg
+                             for arg in instr)
+    defn.registers = fixed + shared
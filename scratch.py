@@ -1,44 +1,63 @@
-from lisp import read, sourcelines
-import machinecode, virtualmachine, ffi
+from lisp import read, sourcelines, cache
+import machinecode, virtualmachine, pysource, codecache, parallel, incremental, binding, inlining, lowering, peephole, regalloc, ffi
 import sys
 
 class Native(object):
-    def __init__(self, fn):
+    def __init__(self, fn, uniform=False):
         self.fn = fn
+        self.vm_uniform = uniform
 
     def vm_call(self, args):
         return self.fn(*args)
 
 scope = machinecode.Scope()
-scope['cdll'] = Native(ffi.CDLL)
-scope['length'] = Native(len)
+scope['cdll'] = Native(ffi.CDLL, uniform=True)
+scope['length'] = Native(len, uniform=True)
 scope['pointer'] = Native(ffi.ctypes.pointer)
 scope['byref'] = Native(ffi.byref)
 
 import operator
 
-scope['!='] = Native(operator.ne)
-scope['=='] = Native(operator.eq)
-scope['<='] = Native(operator.le)
-scope['>='] = Native(operator.ge)
-scope['<'] = Native(operator.lt)
-scope['>'] = Native(operator.gt)
+scope['!='] = Native(operator.ne, uniform=True)
+scope['=='] = Native(operator.eq, uniform=True)
+scope['<='] = Native(operator.le, uniform=True)
+scope['>='] = Native(operator.ge, uniform=True)
+scope['<'] = Native(operator.lt, uniform=True)
+scope['>'] = Native(operator.gt, uniform=True)
 
 def debug(*args):
     print ' '.join(repr(a) for a in args)
 scope['debug'] = Native(debug)
 
-source = read.file(sys.argv[1])
+passes = [lowering.pipeline(lowering.hoist, lowering.deadcode), peephole.optimize, regalloc.allocate]
+program = [binding.bind, inlining.inline]
+lazy = '--lazy' in sys.argv[2:]
 
-#print sourcelines.color(out.location)
-
-closure = machinecode.build(source, scope, machinecode.macros)
+if '--compiled' in sys.argv[2:]:
+    closure = codecache.build(sys.argv[1], scope, machinecode.macros, passes, program)
+elif '--incremental' in sys.argv[2:]:
+    closure = incremental.build(sys.argv[1], scope, machinecode.macros, passes, program)
+else:
+    if '--cache' in sys.argv[2:]:
+        source = cache.file(sys.argv[1])
+    else:
+        source = read.stream(sys.argv[1], lazy)
+    #print sourcelines.color(out.location)
+    if '--jobs' in sys.argv[2:]:
+        pool = parallel.start(passes)
+        closure = parallel.build(source, scope, machinecode.macros, pool, passes, program)
+        pool.close()
+    else:
+        closure = machinecode.build(source, scope, machinecode.macros, passes, program, lazy)
 
 print closure
 for block in closure.defn.blocks:
     print block
 
-frame, res = virtualmachine.run(closure, [])
+if '--python' in sys.argv[2:]:
+    frame, res = pysource.run(closure, [])
+else:
+    frame, res = virtualmachine.run(closure, [])
 
 closure = frame.lookup('main')
 print closure
@@ -1,66 +1,302 @@
-import machinecode
+import machinecode, bytecode
+from bytecode import MOVE, CALL, CALLATTR, GETATTR, SETATTR, CLOSURE, \
+    LOADCELL, STORECELL, BRANCH, CBRANCH, RETURN, END, TAILCALL, TAILCALLATTR, \
+    CALL_CBRANCH, CALL_BRANCH, CALL_CALL, MOVE_MOVE, MOVE_BRANCH, MOVE_CALL, \
+    LOADCELL_CALL, LOADCELL_TAILCALL
 
+class Frame(object):
+    __slots__ = ('ret', 'closure', 'defn', 'code', 'regs', 'cells',
+                 'block', 'pc', 'result', 'value')
+
+    def __init__(self, ret, closure):
+        self.ret = ret
+        self.closure = closure
+        self.defn = defn = closure.defn
+        if defn.code is None:
+            if defn.stub is not None:
+                machinecode.realize(defn)
+            defn.code = bytecode.compile(defn)
+        self.code = code = defn.code
+        self.regs = code.template[:]
+        self.cells = [machinecode.Cell() for _ in range(code.ncells)]
+        self.cells.extend(closure.cells)
+        self.block = code.entry
+        self.pc = 0
+        self.result = None
+        self.value = None
+
+    def pass_arguments(self, argv):
+        params = self.code.params
+        if len(params) < len(argv):
+            return False
+        regs = self.regs
+        for i, value in enumerate(argv):
+            regs[params[i]] = value
+        return True
+
+    def lookup(self, name):
+        arg = self.defn.scope.lookup(name)
+        if isinstance(arg, machinecode.VirtualRegister):
+            arg = self.defn.cells.get(arg, arg)
+            if arg.defn is not self.defn:
+                return None
+        if isinstance(arg, machinecode.CellRegister):
+            return self.cells[arg.index].value
+        if isinstance(arg, machinecode.VirtualRegister):
+            return self.regs[arg.index]
+        return arg
+
+def enter(ret, callee, argv):
+    frame = Frame(ret, callee)
+    if not frame.pass_arguments(argv):
+        raise Exception("too few arguments")
+    return frame
+
+# Each opcode has a handler taking the frame, its slots and the
+# instruction. A handler returns None to go on with the next instruction,
+# or the frame to continue in, after it has set that frame's block and pc.
+table = [None] * len(bytecode.names)
+
+def handler(opcode):
+    def register(fn):
+        table[opcode] = fn
+        return fn
+    return register
+
+# Returned once the root frame returns.
+halt = object()
+
+@handler(MOVE)
+def op_move(frame, regs, instr):
+    regs[instr[1]] = regs[instr[2]]
+
+@handler(CALL)
+def op_call(frame, regs, instr):
+    callee = regs[instr[2]]
+    argv = [regs[i] for i in instr[3:]]
+    if isinstance(callee, machinecode.Closure):
+        frame.result = instr[1]
+        return enter(frame, callee, argv)
+    regs[instr[1]] = callee.vm_call(argv)
+
+@handler(CALLATTR)
+def op_callattr(frame, regs, instr):
+    callee = regs[instr[2]].vm_getattr(regs[instr[3]])
+    argv = [regs[i] for i in instr[4:]]
+    if isinstance(callee, machinecode.Closure):
+        frame.result = instr[1]
+        return enter(frame, callee, argv)
+    regs[instr[1]] = callee.vm_call(argv)
+
+# A closure called in tail position takes over the frame's caller, and
+# the frame is dropped. The root frame stays for lookup(), so it calls
+# as usual and returns with the instruction that follows.
+def tailcall(frame, regs, dst, callee, argv):
+    if isinstance(callee, machinecode.Closure) and frame.ret is not None:
+        return enter(frame.ret, callee, argv)
+    if isinstance(callee, machinecode.Closure):
+        frame.result = dst
+        return enter(frame, callee, argv)
+    regs[dst] = callee.vm_call(argv)
+
+@handler(TAILCALL)
+def op_tailcall(frame, regs, instr):
+    argv = [regs[i] for i in instr[3:]]
+    return tailcall(frame, regs, instr[1], regs[instr[2]], argv)
+
+@handler(TAILCALLATTR)
+def op_tailcallattr(frame, regs, instr):
+    callee = regs[instr[2]].vm_getattr(regs[instr[3]])
+    argv = [regs[i] for i in instr[4:]]
+    return tailcall(frame, regs, instr[1], callee, argv)
+
+@handler(GETATTR)
+def op_getattr(frame, regs, instr):
+    regs[instr[1]] = regs[instr[2]].vm_getattr(regs[instr[3]])
+
+@handler(SETATTR)
+def op_setattr(frame, regs, instr):
+    regs[instr[1]].vm_setattr(regs[instr[2]], regs[instr[3]])
+
+@handler(CLOSURE)
+def op_closure(frame, regs, instr):
+    cells = [frame.cells[index] for index in instr[3]]
+    regs[instr[1]] = machinecode.Closure(instr[2], cells)
+
+@handler(LOADCELL)
+def op_loadcell(frame, regs, instr):
+    regs[instr[1]] = frame.cells[instr[2]].value
+
+@handler(STORECELL)
+def op_storecell(frame, regs, instr):
+    frame.cells[instr[1]].value = regs[instr[2]]
+
+@handler(BRANCH)
+def op_branch(frame, regs, instr):
+    frame.block = instr[1]
+    frame.pc = 0
+    return frame
+
+@handler(CBRANCH)
+def op_cbranch(frame, regs, instr):
+    if regs[instr[1]]:
+        frame.block = instr[2]
+    else:
+        frame.block = instr[3]
+    frame.pc = 0
+    return frame
+
+# Superinstructions, see bytecode.fuse. When a fused call enters a
+# closure, the instruction kept after it runs once the closure returns.
+@handler(CALL_CBRANCH)
+def op_call_cbranch(frame, regs, instr):
+    callee = regs[instr[4]]
+    argv = [regs[i] for i in instr[5:]]
+    if isinstance(callee, machinecode.Closure):
+        frame.result = instr[3]
+        return enter(frame, callee, argv)
+    value = regs[instr[3]] = callee.vm_call(argv)
+    if value:
+        frame.block = instr[1]
+    else:
+        frame.block = instr[2]
+    frame.pc = 0
+    return frame
+
+@handler(CALL_BRANCH)
+def op_call_branch(frame, regs, instr):
+    callee = regs[instr[3]]
+    argv = [regs[i] for i in instr[4:]]
+    if isinstance(callee, machinecode.Closure):
+        frame.result = instr[2]
+        return enter(frame, callee, argv)
+    regs[instr[2]] = callee.vm_call(argv)
+    frame.block = instr[1]
+    frame.pc = 0
+    return frame
+
+# A second call that enters a closure is left to the kept instruction.
+@handler(CALL_CALL)
+def op_call_call(frame, regs, instr):
+    first = instr[3]
+    callee = regs[first[1]]
+    argv = [regs[i] for i in first[2:]]
+    if isinstance(callee, machinecode.Closure):
+        frame.result = first[0]
+        return enter(frame, callee, argv)
+    regs[first[0]] = callee.vm_call(argv)
+    second = instr[4]
+    callee = regs[second[1]]
+    frame.block = instr[1]
+    if isinstance(callee, machinecode.Closure):
+        frame.pc = instr[2] - 1
+        return frame
+    regs[second[0]] = callee.vm_call([regs[i] for i in second[2:]])
+    frame.pc = instr[2]
+    return frame
+
+@handler(MOVE_MOVE)
+def op_move_move(frame, regs, instr):
+    regs[instr[1]] = regs[instr[2]]
+    regs[instr[3]] = regs[instr[4]]
+
+@handler(MOVE_BRANCH)
+def op_move_branch(frame, regs, instr):
+    regs[instr[1]] = regs[instr[2]]
+    frame.block = instr[3]
+    frame.pc = 0
+    return frame
+
+@handler(MOVE_CALL)
+def op_move_call(frame, regs, instr):
+    regs[instr[1]] = regs[instr[2]]
+    callee = regs[instr[4]]
+    argv = [regs[i] for i in instr[5:]]
+    if isinstance(callee, machinecode.Closure):
+        frame.result = instr[3]
+        return enter(frame, callee, argv)
+    regs[instr[3]] = callee.vm_call(argv)
+
+@handler(LOADCELL_CALL)
+def op_loadcell_call(frame, regs, instr):
+    regs[instr[1]] = frame.cells[instr[2]].value
+    callee = regs[instr[4]]
+    argv = [regs[i] for i in instr[5:]]
+    if isinstance(callee, machinecode.Closure):
+        frame.result = instr[3]
+        return enter(frame, callee, argv)
+    regs[instr[3]] = callee.vm_call(argv)
+
+@handler(LOADCELL_TAILCALL)
+def op_loadcell_tailcall(frame, regs, instr):
+    regs[instr[1]] = frame.cells[instr[2]].value
+    argv = [regs[i] for i in instr[5:]]
+    return tailcall(frame, regs, instr[3], regs[instr[4]], argv)
+
+def leave(frame, value):
+    ret = frame.ret
+    if ret is None:
+        frame.value = value
+        return halt
+    ret.regs[ret.result] = value
+    return ret
+
+@handler(RETURN)
+def op_return(frame, regs, instr):
+    return leave(frame, regs[instr[1]])
+
+@handler(END)
+def op_end(frame, regs, instr):
+    return leave(frame, None)
+
+# The current block, pc and slots are kept in locals. They are written
+# back to the frame only when another frame takes over.
 def run(closure, argv):
-    root = frame = machinecode.Frame(None, closure)
+    root = frame = Frame(None, closure)
+    frame.pass_arguments(argv)
+    block = frame.block
+    regs = frame.regs
+    pc = 0
+    while True:
+        instr = block[pc]
+        pc += 1
+        target = table[instr[0]](frame, regs, instr)
+        if target is not None:
+            if target is halt:
+                return root, root.value
+            if target is not frame:
+                frame.block = block
+                frame.pc = pc
+                frame = target
+                regs = frame.regs
+            block = frame.block
+            pc = frame.pc
+
+# Runs like run() and counts how often each opcode follows another in
+# the same block. The counts pick the pairs that bytecode fuses.
+def profile(closure, argv):
+    pairs = {}
+    root = frame = Frame(None, closure)
     frame.pass_arguments(argv)
+    block = frame.block
+    regs = frame.regs
+    pc = 0
+    last = None
     while True:
-        if frame.pc >= len(frame.block):
-            if frame is root:
-                return root, None
-            else:
-                frame = frame.ret.resume(None)
-                continue
-        instr = frame.block[frame.pc]
-        frame.pc += 1
-        name = instr[0]
-        if name == 'call':
-            frame.entryvar = instr[1]
-            callee = frame.fetch(instr[2])
-            argv = [frame.fetch(arg) for arg in instr[3:]]
-            if isinstance(callee, machinecode.Closure):
-                frame = machinecode.Frame(frame, callee)
-                if not frame.pass_arguments(argv):
-                    raise Exception("too few arguments")
-            else:
-                frame.store(frame.entryvar, callee.vm_call(argv))
-        elif name == 'return':
-            if frame is root:
-                return root, None
-            else:
-                frame = frame.ret.resume(frame.fetch(instr[1]))
-        elif name == 'getattr':
-            obj = frame.fetch(instr[2])
-            name = frame.fetch(instr[3])
-            frame.store(instr[1], obj.vm_getattr(name))
-        elif name == 'setattr':
-            obj = frame.fetch(instr[1])
-            name = frame.fetch(instr[2])
-            obj.vm_setattr(name, frame.fetch(instr[3]))
-        elif name == 'callattr':
-            frame.entryvar = instr[1]
-            obj = frame.fetch(instr[2])
-            name = frame.fetch(instr[3])
-            argv = [frame.fetch(arg) for arg in instr[4:]]
-            callee = obj.vm_getattr(name)
-            if isinstance(callee, machinecode.Closure):
-                frame = machinecode.Frame(frame, callee)
-                if not frame.pass_arguments(argv):
-                    raise Exception("too few arguments")
-            else:
-                frame.store(frame.entryvar, callee.vm_call(argv))
-        elif name == 'move':
-            frame.store(instr[1], frame.fetch(instr[2]))
-        elif name == 'closure':
-            frame.store(instr[1], machinecode.Closure(frame, instr[2]))
-        elif name == 'branch':
-            frame.block = frame.closure.defn.blocks[instr[1]]
-            frame.pc = 0
-        elif name == 'cbranch':
-            cond = frame.fetch(instr[1])
-            if cond:
-                frame.block = frame.closure.defn.blocks[instr[2]]
-            else:
-                frame.block = frame.closure.defn.blocks[instr[3]]
-            frame.pc = 0
-        else:
-            raise Exception("no such instruction %s" % name)
+        instr = block[pc]
+        pc += 1
+        key = (last, instr[0])
+        pairs[key] = pairs.get(key, 0) + 1
+        last = instr[0]
+        target = table[instr[0]](frame, regs, instr)
+        if target is not None:
+            if target is halt:
+                return pairs
+            if target is not frame:
+                frame.block = block
+                frame.pc = pc
+                frame = target
+                regs = frame.regs
+            block = frame.block
+            pc = frame.pc
+            last = None